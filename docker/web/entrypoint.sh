@@ -105,6 +105,12 @@ EOF
 # Disable SSL mode for internal docker communication
 sed -i "s/'sslmode': 'require'/'sslmode': 'disable'/g" /app/db.py
 
+# Workers share their metrics through files in METRICS_DIR, start counting from zero
+if [ -n "$METRICS_DIR" ]; then
+	rm -rf "$METRICS_DIR"
+	mkdir -p "$METRICS_DIR"
+fi
+
 echo "Starting web server..."
 exec gunicorn -w 3 -b 0.0.0.0:8000 \
 	--log-level=info \
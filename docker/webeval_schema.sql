@@ -31,6 +31,7 @@ CREATE TABLE users (
     sso_identifier character varying(255),
     sso_linked_at timestamp with time zone,
     password_login_enabled boolean NOT NULL DEFAULT true,
+    scoreboard_hidden boolean NOT NULL DEFAULT false,
     PRIMARY KEY (id),
     UNIQUE (email),
     UNIQUE (username)
@@ -44,6 +45,7 @@ COMMENT ON COLUMN users.sso_provider IS 'SSO provider name (e.g., ctu_fel)';
 COMMENT ON COLUMN users.sso_identifier IS 'Unique identifier from SSO provider (e.g., preferred_username)';
 COMMENT ON COLUMN users.sso_linked_at IS 'Timestamp when SSO was linked to this account';
 COMMENT ON COLUMN users.password_login_enabled IS 'Whether password-based login is allowed (false for SSO-only accounts)';
+COMMENT ON COLUMN users.scoreboard_hidden IS 'Excluded from scoreboards by an admin (mirrors config/filter)';
 
 --
 -- Table: tasks
@@ -82,6 +84,7 @@ CREATE TABLE results (
     score_best integer,
     "time" timestamp with time zone,
     result integer,
+    submission_id integer,
     PRIMARY KEY (userid, taskid),
     FOREIGN KEY (userid) REFERENCES users(id) ON DELETE CASCADE,
     FOREIGN KEY (taskid) REFERENCES tasks(id) ON DELETE CASCADE
@@ -90,6 +93,8 @@ CREATE TABLE results (
 CREATE INDEX idx_results_userid ON results(userid);
 CREATE INDEX idx_results_taskid ON results(taskid);
 
+COMMENT ON COLUMN results.submission_id IS 'Submission that produced score_last, result and result_file, results of older submissions do not overwrite them';
+
 --
 -- Table: submissions
 --
@@ -100,6 +105,10 @@ CREATE TABLE submissions (
     file text NOT NULL,
     evaluated boolean NOT NULL DEFAULT false,
     "time" timestamp with time zone NOT NULL DEFAULT NOW(),
+    claimed_by character varying(255),
+    claimed_at timestamp with time zone,
+    low_priority boolean NOT NULL DEFAULT false,
+    skipped boolean NOT NULL DEFAULT false,
     PRIMARY KEY (id),
     FOREIGN KEY (userid) REFERENCES users(id) ON DELETE CASCADE,
     FOREIGN KEY (taskid) REFERENCES tasks(id) ON DELETE CASCADE
@@ -118,6 +127,12 @@ ALTER TABLE ONLY submissions ALTER COLUMN id SET DEFAULT nextval('submissions_id
 CREATE INDEX idx_submissions_userid ON submissions(userid);
 CREATE INDEX idx_submissions_taskid ON submissions(taskid);
 CREATE INDEX idx_submissions_evaluated ON submissions(evaluated);
+CREATE INDEX idx_submissions_pending ON submissions(id) WHERE evaluated = false;
+
+COMMENT ON COLUMN submissions.claimed_by IS 'Evaluator instance currently evaluating the submission';
+COMMENT ON COLUMN submissions.claimed_at IS 'Start of the claim lease, expired leases are re-queued';
+COMMENT ON COLUMN submissions.low_priority IS 'Re-evaluation requested by an admin, evaluated after all other submissions';
+COMMENT ON COLUMN submissions.skipped IS 'Not evaluated, superseded by a newer submission of the same user (task option coalesce)';
 
 --
 -- Table: submission_statistics
@@ -157,6 +172,22 @@ CREATE TRIGGER trigger_update_submission_statistics
     FOR EACH ROW
     EXECUTE FUNCTION update_submission_statistics();
 
+--
+-- Trigger function to notify evaluators about new submissions
+--
+CREATE OR REPLACE FUNCTION notify_new_submission()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('new_submission', NEW.id::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trigger_notify_new_submission
+    AFTER INSERT ON submissions
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_new_submission();
+
 --
 -- Trigger function to update best score
 --
@@ -194,6 +225,305 @@ CREATE TRIGGER trigger_update_results_timestamp
     FOR EACH ROW
     EXECUTE FUNCTION update_timestamp();
 
+--
+-- Table: leaderboard
+-- Materialized scoreboard ranking, one partition per (scope, scope_value, taskid).
+-- Maintained by the triggers below, read by the web scoreboards.
+--
+CREATE TABLE leaderboard (
+    scope character varying(16) NOT NULL,
+    scope_value character varying(255) NOT NULL DEFAULT '',
+    taskid integer NOT NULL,
+    userid uuid NOT NULL,
+    score_best integer NOT NULL,
+    rank integer NOT NULL,
+    points integer NOT NULL,
+    PRIMARY KEY (scope, scope_value, taskid, userid),
+    FOREIGN KEY (userid) REFERENCES users(id) ON DELETE CASCADE,
+    FOREIGN KEY (taskid) REFERENCES tasks(id) ON DELETE CASCADE
+);
+
+CREATE INDEX idx_leaderboard_userid ON leaderboard(userid);
+
+COMMENT ON COLUMN leaderboard.scope IS 'public, group or org';
+COMMENT ON COLUMN leaderboard.scope_value IS 'Group or organization name, empty for the public scoreboard';
+COMMENT ON COLUMN leaderboard.rank IS 'DENSE_RANK of score_best within the partition (lower score is better)';
+COMMENT ON COLUMN leaderboard.points IS '7 - rank for scores up to the fifth result, 0 for the rest';
+
+--
+-- Table: scoreboard_version
+-- Single row, bumped whenever the data shown on the scoreboards changes (used by the web cache).
+--
+CREATE TABLE scoreboard_version (
+    id integer NOT NULL DEFAULT 1 CHECK (id = 1),
+    version bigint NOT NULL DEFAULT 0,
+    updated_at timestamp with time zone NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id)
+);
+
+INSERT INTO scoreboard_version DEFAULT VALUES;
+
+CREATE OR REPLACE FUNCTION bump_scoreboard_version()
+RETURNS void AS $$
+BEGIN
+    UPDATE scoreboard_version SET version = version + 1, updated_at = NOW();
+END;
+$$ LANGUAGE plpgsql;
+
+--
+-- The version row is updated once per transaction when it commits (deferred triggers below).
+-- Updating it right away would keep the row locked while the transaction goes on locking
+-- leaderboard partitions, two concurrent result commits could deadlock on that.
+--
+CREATE OR REPLACE FUNCTION mark_scoreboard_changed()
+RETURNS void AS $$
+BEGIN
+    PERFORM set_config('webeval.scoreboard_changed', 'on', true);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bump_scoreboard_version_at_commit()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF current_setting('webeval.scoreboard_changed', true) = 'on' THEN
+        PERFORM set_config('webeval.scoreboard_changed', 'off', true);
+        PERFORM bump_scoreboard_version();
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+--
+-- Recompute one leaderboard partition
+--
+CREATE OR REPLACE FUNCTION refresh_leaderboard(p_scope varchar, p_scope_value varchar, p_taskid integer)
+RETURNS void AS $$
+BEGIN
+    -- Serialize concurrent refreshes of the same partition
+    PERFORM pg_advisory_xact_lock(hashtext('leaderboard:' || p_scope || ':' || p_scope_value || ':' || p_taskid));
+
+    DELETE FROM leaderboard WHERE scope = p_scope AND scope_value = p_scope_value AND taskid = p_taskid;
+
+    INSERT INTO leaderboard (scope, scope_value, taskid, userid, score_best, rank, points)
+    SELECT p_scope, p_scope_value, p_taskid, userid, score_best, score_rank,
+        CASE WHEN score_best <= MAX(score_best) FILTER (WHERE position <= 5) OVER () THEN 7 - score_rank ELSE 0 END
+    FROM (
+        SELECT results.userid, results.score_best,
+            DENSE_RANK() OVER (ORDER BY results.score_best ASC) AS score_rank,
+            ROW_NUMBER() OVER (ORDER BY results.score_best ASC) AS position
+        FROM results INNER JOIN users ON results.userid = users.id
+        WHERE results.taskid = p_taskid
+            AND results.score_best > 0
+            AND users.verified = true
+            AND users.scoreboard_hidden = false
+            AND CASE p_scope
+                WHEN 'public' THEN users.visibility = 0
+                WHEN 'group' THEN users."group" = p_scope_value AND users.visibility IN (2, 0)
+                WHEN 'org' THEN users.organization = p_scope_value AND users.visibility IN (1, 0)
+            END
+    ) ranked;
+
+    PERFORM mark_scoreboard_changed();
+END;
+$$ LANGUAGE plpgsql;
+
+--
+-- Recompute the partitions a user (with the given visibility, group and organization) can appear in.
+-- p_taskid NULL means all tasks.
+--
+CREATE OR REPLACE FUNCTION refresh_user_leaderboards(p_visibility integer, p_group varchar, p_organization varchar, p_taskid integer)
+RETURNS void AS $$
+DECLARE
+    task_id integer;
+BEGIN
+    FOR task_id IN SELECT id FROM tasks WHERE p_taskid IS NULL OR id = p_taskid LOOP
+        IF p_visibility = 0 THEN
+            PERFORM refresh_leaderboard('public', '', task_id);
+        END IF;
+        IF p_group IS NOT NULL AND p_visibility IN (2, 0) THEN
+            PERFORM refresh_leaderboard('group', p_group, task_id);
+        END IF;
+        IF p_organization IS NOT NULL AND p_visibility IN (1, 0) THEN
+            PERFORM refresh_leaderboard('org', p_organization, task_id);
+        END IF;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+--
+-- Rebuild the whole leaderboard
+--
+CREATE OR REPLACE FUNCTION rebuild_leaderboard()
+RETURNS void AS $$
+DECLARE
+    task_id integer;
+    scope_name varchar;
+BEGIN
+    DELETE FROM leaderboard;
+    FOR task_id IN SELECT id FROM tasks LOOP
+        PERFORM refresh_leaderboard('public', '', task_id);
+        FOR scope_name IN SELECT DISTINCT "group" FROM users WHERE "group" IS NOT NULL LOOP
+            PERFORM refresh_leaderboard('group', scope_name, task_id);
+        END LOOP;
+        FOR scope_name IN SELECT DISTINCT organization FROM users WHERE organization IS NOT NULL LOOP
+            PERFORM refresh_leaderboard('org', scope_name, task_id);
+        END LOOP;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+--
+-- Trigger function to update the leaderboard when a best score changes
+--
+CREATE OR REPLACE FUNCTION update_leaderboard_on_result()
+RETURNS TRIGGER AS $$
+DECLARE
+    result_row results%ROWTYPE;
+    result_user users%ROWTYPE;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        result_row := OLD;
+    ELSE
+        result_row := NEW;
+    END IF;
+
+    -- score_best is usually changed by update_best_score, not by the UPDATE itself,
+    -- so the trigger cannot be limited with UPDATE OF score_best
+    IF TG_OP = 'UPDATE' AND OLD.score_best IS NOT DISTINCT FROM NEW.score_best THEN
+        RETURN NULL;
+    END IF;
+
+    SELECT * INTO result_user FROM users WHERE id = result_row.userid;
+    IF NOT FOUND OR NOT result_user.verified OR result_user.scoreboard_hidden THEN
+        RETURN NULL;
+    END IF;
+
+    PERFORM refresh_user_leaderboards(result_user.visibility, result_user."group", result_user.organization, result_row.taskid);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trigger_update_leaderboard_on_result
+    AFTER INSERT OR UPDATE OR DELETE ON results
+    FOR EACH ROW
+    EXECUTE FUNCTION update_leaderboard_on_result();
+
+--
+-- Trigger function to update the leaderboard when a user moves between scoreboards
+--
+CREATE OR REPLACE FUNCTION update_leaderboard_on_user()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'UPDATE'
+        AND OLD.verified = NEW.verified
+        AND OLD.scoreboard_hidden = NEW.scoreboard_hidden
+        AND OLD.visibility = NEW.visibility
+        AND OLD."group" IS NOT DISTINCT FROM NEW."group"
+        AND OLD.organization IS NOT DISTINCT FROM NEW.organization THEN
+        -- Names are not part of the leaderboard, but they are shown on the scoreboards
+        IF OLD.username <> NEW.username OR OLD.display_name IS DISTINCT FROM NEW.display_name THEN
+            PERFORM mark_scoreboard_changed();
+        END IF;
+        RETURN NULL;
+    END IF;
+
+    PERFORM refresh_user_leaderboards(OLD.visibility, OLD."group", OLD.organization, NULL);
+    IF TG_OP = 'UPDATE' THEN
+        PERFORM refresh_user_leaderboards(NEW.visibility, NEW."group", NEW.organization, NULL);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trigger_update_leaderboard_on_user
+    AFTER UPDATE OR DELETE ON users
+    FOR EACH ROW
+    EXECUTE FUNCTION update_leaderboard_on_user();
+
+--
+-- Trigger function to invalidate cached scoreboards when tasks are added, renamed, reordered or hidden
+--
+CREATE OR REPLACE FUNCTION bump_scoreboard_version_on_tasks()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM mark_scoreboard_changed();
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trigger_bump_scoreboard_version_on_tasks
+    AFTER INSERT OR UPDATE OR DELETE ON tasks
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION bump_scoreboard_version_on_tasks();
+
+CREATE CONSTRAINT TRIGGER trigger_bump_scoreboard_version_at_commit
+    AFTER INSERT OR UPDATE OR DELETE ON results
+    DEFERRABLE INITIALLY DEFERRED
+    FOR EACH ROW
+    EXECUTE FUNCTION bump_scoreboard_version_at_commit();
+
+CREATE CONSTRAINT TRIGGER trigger_bump_scoreboard_version_at_commit
+    AFTER INSERT OR UPDATE OR DELETE ON users
+    DEFERRABLE INITIALLY DEFERRED
+    FOR EACH ROW
+    EXECUTE FUNCTION bump_scoreboard_version_at_commit();
+
+CREATE CONSTRAINT TRIGGER trigger_bump_scoreboard_version_at_commit
+    AFTER INSERT OR UPDATE OR DELETE ON tasks
+    DEFERRABLE INITIALLY DEFERRED
+    FOR EACH ROW
+    EXECUTE FUNCTION bump_scoreboard_version_at_commit();
+
+--
+-- Table: result_cache
+-- Results of earlier evaluations, reused by the evaluator for identical code and task.
+--
+CREATE TABLE result_cache (
+    source_hash character(64) NOT NULL,
+    task_digest character(64) NOT NULL,
+    simulator_version character varying(255) NOT NULL,
+    preprocessor_seed character varying(64) NOT NULL DEFAULT '',
+    score integer NOT NULL,
+    result integer NOT NULL,
+    result_file text,
+    eval_seconds double precision NOT NULL,
+    hits integer NOT NULL DEFAULT 0,
+    created_at timestamp with time zone NOT NULL DEFAULT NOW(),
+    last_hit_at timestamp with time zone,
+    PRIMARY KEY (source_hash, task_digest, simulator_version, preprocessor_seed)
+);
+
+COMMENT ON COLUMN result_cache.source_hash IS 'sha256 of the submitted code';
+COMMENT ON COLUMN result_cache.task_digest IS 'sha256 of the task file';
+COMMENT ON COLUMN result_cache.simulator_version IS 'Output of qtrvsim_cli --version';
+COMMENT ON COLUMN result_cache.preprocessor_seed IS 'preprocessor_seed of the task, empty for tasks without a preprocessor';
+COMMENT ON COLUMN result_cache.eval_seconds IS 'Duration of the original evaluation, saved again by every hit';
+
+--
+-- Table: resource_usage
+-- Resources used by the make and qtrvsim_cli runs of an evaluated submission, one row per kind of run.
+--
+CREATE TABLE resource_usage (
+    submission_id integer NOT NULL,
+    taskid integer NOT NULL,
+    kind character varying(16) NOT NULL,
+    runs integer NOT NULL,
+    wall_seconds double precision NOT NULL,
+    user_seconds double precision NOT NULL,
+    sys_seconds double precision NOT NULL,
+    max_rss_kb bigint NOT NULL,
+    created_at timestamp with time zone NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (submission_id, kind),
+    FOREIGN KEY (submission_id) REFERENCES submissions(id) ON DELETE CASCADE,
+    FOREIGN KEY (taskid) REFERENCES tasks(id) ON DELETE CASCADE
+);
+
+CREATE INDEX idx_resource_usage_taskid ON resource_usage(taskid);
+
+COMMENT ON COLUMN resource_usage.kind IS 'make or simulate';
+COMMENT ON COLUMN resource_usage.runs IS 'Number of runs, the times are their sums';
+COMMENT ON COLUMN resource_usage.max_rss_kb IS 'Peak resident memory of the largest run';
+
 --
 -- Table: api_keys
 --
@@ -232,3 +562,7 @@ ALTER TABLE results OWNER TO qtrvsim;
 ALTER TABLE submissions OWNER TO qtrvsim;
 ALTER TABLE submission_statistics OWNER TO qtrvsim;
 ALTER TABLE api_keys OWNER TO qtrvsim;
+ALTER TABLE leaderboard OWNER TO qtrvsim;
+ALTER TABLE scoreboard_version OWNER TO qtrvsim;
+ALTER TABLE result_cache OWNER TO qtrvsim;
+ALTER TABLE resource_usage OWNER TO qtrvsim;
@@ -0,0 +1,133 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import subprocess
+from qtrvsim import ASSEMBLER
+
+# Set EVAL_BUILD_CACHE=0 to always run make
+ENABLED = os.getenv('EVAL_BUILD_CACHE', '1') != '0'
+
+# Shared by all workers, one directory per build
+CACHE_DIR = os.getenv('EVAL_BUILD_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'qtrvsim_build_cache')
+
+# The least recently used builds are removed above this number of entries
+MAX_ENTRIES = int(os.getenv('EVAL_BUILD_CACHE_ENTRIES') or 1000)
+
+_toolchain_version = None
+
+# Statistics of this process
+hits = 0
+lookups = 0
+
+def toolchain_version():
+	"""Return the first line of the compiler --version output, None if the compiler is not available."""
+	global _toolchain_version
+	if _toolchain_version is None:
+		try:
+			process = subprocess.run([ASSEMBLER, "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=10)
+			_toolchain_version = process.stdout.decode('utf-8').split('\n')[0].strip() if process.returncode == 0 else ''
+		except (OSError, subprocess.TimeoutExpired):
+			_toolchain_version = ''
+	return _toolchain_version or None
+
+def make_key(source_name, source, files):
+	"""Return the cache key of building <source> saved as <source_name> together with <files> ({file name: content}, including the Makefile).
+
+	Returns None when the build must not be reused (the cache is disabled or the toolchain is unknown).
+	"""
+	if not ENABLED:
+		return None
+
+	version = toolchain_version()
+	if version is None:
+		return None
+
+	data = json.dumps([source_name, source, sorted(files.items()), version])
+	return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+def restore(key, sim):
+	"""Put the outcome of a cached build into <sim> (QtRVSim), returns False on a miss."""
+	global hits, lookups
+	if key is None:
+		return False
+
+	lookups += 1
+	entry = os.path.join(CACHE_DIR, key)
+	try:
+		with open(os.path.join(entry, 'build.json')) as f:
+			build = json.load(f)
+		#failed builds stored by older versions are not replayed, remove them so the next build is stored
+		if not build['successful']:
+			shutil.rmtree(entry, ignore_errors=True)
+			return False
+		shutil.copy2(os.path.join(entry, 'executable'), sim.get_executable_file())
+		#mark as recently used
+		os.utime(entry)
+	except (OSError, ValueError, KeyError):
+		return False
+
+	hits += 1
+	sim.makefile_successfull = build['successful']
+	sim.makefile_log = build['makefile_log']
+	sim.log += build['log']
+	return True
+
+def store(key, sim, log):
+	"""Remember the outcome of the build of <sim>, <log> is what the build added to its log.
+
+	Only successful builds are stored, a failure can be caused by the machine (full disk, OOM
+	killer, missing toolchain) and make cannot tell it from a compile error."""
+	if key is None or not sim.makefile_successfull:
+		return
+
+	try:
+		os.makedirs(CACHE_DIR, exist_ok=True)
+		#written into a temporary directory and renamed, so other workers never read a partial entry
+		tmp_entry = tempfile.mkdtemp(prefix='_tmp_', dir=CACHE_DIR)
+		try:
+			shutil.copy2(sim.get_executable_file(), os.path.join(tmp_entry, 'executable'))
+			with open(os.path.join(tmp_entry, 'build.json'), 'w') as f:
+				json.dump({'successful': sim.makefile_successfull, 'makefile_log': sim.makefile_log, 'log': log}, f)
+			os.rename(tmp_entry, os.path.join(CACHE_DIR, key))
+		except OSError:
+			#also when another worker stored the same build first
+			shutil.rmtree(tmp_entry, ignore_errors=True)
+			return
+		evict()
+	except OSError as e:
+		print(f"  build cache store failed: {e}")
+
+def evict():
+	"""Remove the least recently used builds above MAX_ENTRIES."""
+	entries = [os.path.join(CACHE_DIR, name) for name in os.listdir(CACHE_DIR) if not name.startswith('_tmp_')]
+	if len(entries) <= MAX_ENTRIES:
+		return
+
+	def last_used(path):
+		try:
+			return os.stat(path).st_mtime
+		except OSError:
+			return 0
+
+	entries.sort(key=last_used)
+	for path in entries[:len(entries) - MAX_ENTRIES]:
+		shutil.rmtree(path, ignore_errors=True)
+
+def run_make(sim, key):
+	"""Run make for <sim> (QtRVSim), or restore the outcome of an identical earlier build with <key>.
+
+	Returns True when the build was restored from the cache."""
+	if restore(key, sim):
+		return True
+
+	log_start = len(sim.log)
+	sim.run_make()
+	store(key, sim, sim.log[log_start:])
+	return False
+
+def report():
+	"""Statistics of this process as a short text."""
+	rate = 100 * hits / lookups if lookups else 0
+	return f"build cache: {hits}/{lookups} hits ({rate:.0f} %)"
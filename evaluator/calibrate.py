@@ -0,0 +1,110 @@
+import os
+import sys
+import math
+import argparse
+import toml
+from datetime import datetime, timezone
+import taskcache
+import workspace
+import resultcache
+import evaluator
+
+# Budget multiples of the slowest testcase of the reference solution
+TIME_FACTOR = 10
+CYCLE_FACTOR = 10
+
+# Shortest wall time budget, qtrvsim_cli needs a moment to start even on a loaded machine
+MIN_TIMEOUT = 1.0 #seconds
+
+class CalibrationError(Exception):
+	pass
+
+def reference_source(task_filename, task):
+	'''Read the reference solution of the task, its path is relative to the task file.'''
+	reference = task.data.get('task', {}).get('reference_solution', None)
+	if reference is None:
+		raise CalibrationError(f"{task_filename} has no reference_solution")
+
+	with open(os.path.join(os.path.dirname(task_filename), reference)) as f:
+		return f.read()
+
+def measure(task_filename, runs):
+	'''Evaluate the reference solution <runs> times, returns (seconds, cycles) of its slowest testcase.
+
+	The budget of the task is not applied, so that an old budget cannot make the reference fail.
+	'''
+	task = taskcache.get_task(task_filename)
+	source = reference_source(task_filename, task)
+	task_name = os.path.splitext(os.path.basename(task_filename))[0]
+
+	seconds = 0.0
+	cycles = 0
+	for run in range(runs):
+		#a random task gets new data in every run
+		job = evaluator.Job((0, task_name, source, False, None), task_filename, workspace.create(f"_calibrate_{task_name}_"))
+		job.use_budget = False
+		try:
+			evaluator.simulate_stage(job)
+		finally:
+			workspace.remove(job.job_dir)
+
+		score, result, log = job.outcome
+		if result != 0:
+			raise CalibrationError(f"the reference solution of {task_filename} was not accepted (result {result}):\n{log}")
+
+		for timing in job.sim.timings:
+			seconds = max(seconds, timing["simulate"])
+			cycles = max(cycles, timing["cycles"])
+
+	return (seconds, cycles)
+
+def calibrate(task_filename, runs=3, time_factor=TIME_FACTOR, cycle_factor=CYCLE_FACTOR):
+	'''Measure the reference solution of the task and write the budget file next to the task file.
+
+	Returns the budget, the cycle limit is left out with <cycle_factor> 0.'''
+	seconds, cycles = measure(task_filename, runs)
+
+	budget = {
+		'timeout': max(MIN_TIMEOUT, round(seconds * time_factor, 2)),
+		'reference_seconds': round(seconds, 4),
+		'reference_cycles': cycles,
+		'time_factor': time_factor,
+		'calibrated_at': datetime.now(timezone.utc).strftime(taskcache.DEADLINE_FORMAT),
+	}
+	if cycle_factor > 0 and cycles > 0:
+		budget['cycle_limit'] = math.ceil(cycles * cycle_factor)
+		budget['cycle_factor'] = cycle_factor
+
+	#replaced at once, evaluators read the file while it is written
+	path = taskcache.budget_path(task_filename)
+	with open(path + '.tmp', 'w') as f:
+		f.write("# Written by calibrate.py from the reference solution of the task, run it again after changing the task\n")
+		f.write(toml.dumps({'budget': budget}))
+	os.replace(path + '.tmp', path)
+
+	return budget
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Derive the timeout and the cycle limit of tasks from their reference solutions.")
+	parser.add_argument('tasks', nargs='+', help="task files with a reference_solution")
+	parser.add_argument('--runs', type=int, default=3, help="evaluations of the reference solution (default 3)")
+	parser.add_argument('--time-factor', type=float, default=TIME_FACTOR, help=f"timeout as a multiple of the slowest testcase (default {TIME_FACTOR})")
+	parser.add_argument('--cycle-factor', type=float, default=CYCLE_FACTOR, help=f"cycle limit as a multiple of the most cycles, 0 for none (default {CYCLE_FACTOR})")
+	args = parser.parse_args()
+
+	#the reference solution must really run
+	resultcache.ENABLED = False
+
+	failed = False
+	for task_filename in args.tasks:
+		try:
+			budget = calibrate(task_filename, args.runs, args.time_factor, args.cycle_factor)
+		except (CalibrationError, OSError) as e:
+			print(f"{task_filename}: {e}")
+			failed = True
+			continue
+
+		cycle_limit = budget.get('cycle_limit', 'not set')
+		print(f"{task_filename}: timeout {budget['timeout']} s, cycle limit {cycle_limit} (reference: {budget['reference_seconds']} s, {budget['reference_cycles']} cycles)")
+
+	sys.exit(1 if failed else 0)
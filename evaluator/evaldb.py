@@ -1,6 +1,7 @@
 import psycopg2
 from dotenv import load_dotenv
 import os
+import socket
 
 load_dotenv("../.env")
 
@@ -11,49 +12,269 @@ db_config = {
 	'database': os.getenv('DB_DATABASE'),
 	'port': os.getenv('DB_PORT'),
 	'sslmode': 'require',
-	'connect_timeout': 10
+	'connect_timeout': 10,
+	'keepalives': 1,
+	'keepalives_idle': 60
 }
 
+# Identifies this evaluator instance in submissions.claimed_by
+EVALUATOR_ID = os.getenv('EVALUATOR_ID') or f"{socket.gethostname()}:{os.getpid()}"
+
+# Claims older than this are considered abandoned (crashed evaluator) and are re-queued
+LEASE_SECONDS = int(os.getenv('EVAL_LEASE_SECONDS') or 300)
+
+# Channel notified by the submissions insert trigger
+NOTIFY_CHANNEL = 'new_submission'
+
+# Long-lived connection of this process, see get_connection()
+_connection = None
+
+# Connections inherited from the parent process over fork(), they must never be closed here
+_inherited_connections = []
+
+def _forget_connection_after_fork():
+	"""Do not share the parent's connection with a forked worker.
+
+	The object is kept alive, because closing it would terminate the parent's session.
+	"""
+	global _connection
+	if _connection is not None:
+		_inherited_connections.append(_connection)
+		_connection = None
+
+os.register_at_fork(after_in_child=_forget_connection_after_fork)
+
 def connect():
 	"""Connect to the database."""
 	db = psycopg2.connect(**db_config)
 	cursor = db.cursor()
 	return (db, cursor)
 
-def get_latest_submissions(count):
-	"""Fetch the earliest <count> submissions from the database."""
-	(db, cursor) = connect()
-	cursor.execute('SELECT id, taskid, file, evaluated, userid FROM submissions WHERE evaluated = false ORDER BY id ASC LIMIT %s', (count,))
-	submissions = cursor.fetchall()
+def get_connection():
+	"""Return the long-lived connection of this process, (re)connecting when needed."""
+	global _connection
+	if _connection is None or _connection.closed:
+		_connection = psycopg2.connect(**db_config)
+	return _connection
+
+def _drop_connection():
+	"""Throw away a broken connection, the next call reconnects."""
+	global _connection
+	if _connection is not None:
+		try:
+			_connection.close()
+		except psycopg2.Error:
+			pass
+	_connection = None
+
+def run_transaction(work):
+	"""Run work(cursor) in one transaction on the persistent connection and return its result.
+
+	If the connection was lost (server restart, network failure), it reconnects and retries once.
+	"""
+	for attempt in range(2):
+		db = get_connection()
+		try:
+			with db.cursor() as cursor:
+				result = work(cursor)
+			db.commit()
+			return result
+		except (psycopg2.OperationalError, psycopg2.InterfaceError):
+			_drop_connection()
+			if attempt == 1:
+				raise
+		except Exception:
+			if not db.closed:
+				db.rollback()
+			raise
+
+def listen(channel=NOTIFY_CHANNEL):
+	"""Open a dedicated connection that LISTENs on <channel>. Notifications are read with poll()."""
+	db = psycopg2.connect(**db_config)
+	db.set_session(autocommit=True)
+	cursor = db.cursor()
+	cursor.execute(f'LISTEN {channel}')
 	cursor.close()
-	db.close()
-	return submissions
+	return db
+
+def claim_submissions(count, urgent_task_ids=(), coalesced_task_ids=(), worker_id=EVALUATOR_ID):
+	"""Atomically claim the next <count> pending submissions for <worker_id>.
+
+	Pending submissions of <coalesced_task_ids> that are superseded by a newer submission of the
+	same user are not evaluated, they are marked as evaluated and skipped.
+
+	The queue is ordered by lane (re-evaluations requested by an admin go last), then
+	submissions of <urgent_task_ids> (tasks close to their deadline), then round-robin
+	between users: the n-th pending submission of a user, counting the ones already being
+	evaluated, comes after the (n-1)-th submissions of all other users. Ties are broken by id.
+
+	Rows locked by another evaluator are skipped, claims with an expired lease are taken over.
+	Returns (id, taskid, file, evaluated, userid, seconds since the submission) tuples."""
+	def work(cursor):
+		if coalesced_task_ids:
+			cursor.execute('''
+				UPDATE submissions SET evaluated = true, skipped = true, claimed_by = NULL, claimed_at = NULL
+				WHERE id IN (
+					SELECT s.id FROM submissions s
+					WHERE s.evaluated = false AND s.taskid = ANY(%(coalesced)s)
+					AND (s.claimed_at IS NULL OR s.claimed_at < NOW() - %(lease)s * INTERVAL '1 second')
+					AND EXISTS (SELECT 1 FROM submissions n WHERE n.userid = s.userid AND n.taskid = s.taskid AND n.id > s.id)
+					FOR UPDATE SKIP LOCKED
+				)
+			''', {'coalesced': list(coalesced_task_ids), 'lease': LEASE_SECONDS})
+
+		cursor.execute('''
+			WITH running AS (
+				SELECT userid, COUNT(*) AS count FROM submissions
+				WHERE evaluated = false AND claimed_at >= NOW() - %(lease)s * INTERVAL '1 second'
+				GROUP BY userid
+			),
+			queue AS (
+				SELECT s.id, s.low_priority, s.taskid = ANY(%(urgent)s) AS urgent,
+					ROW_NUMBER() OVER (PARTITION BY s.userid ORDER BY s.low_priority, s.id) + COALESCE(r.count, 0) AS turn
+				FROM submissions s
+				LEFT JOIN running r ON r.userid = s.userid
+				WHERE s.evaluated = false AND (s.claimed_at IS NULL OR s.claimed_at < NOW() - %(lease)s * INTERVAL '1 second')
+			)
+			UPDATE submissions SET claimed_by = %(worker)s, claimed_at = NOW()
+			FROM (
+				SELECT s.id, q.low_priority, q.urgent, q.turn FROM submissions s
+				JOIN queue q ON q.id = s.id
+				WHERE s.evaluated = false AND (s.claimed_at IS NULL OR s.claimed_at < NOW() - %(lease)s * INTERVAL '1 second')
+				ORDER BY q.low_priority, q.urgent DESC, q.turn, s.id
+				LIMIT %(count)s
+				FOR UPDATE OF s SKIP LOCKED
+			) AS picked
+			WHERE submissions.id = picked.id
+			RETURNING submissions.id, submissions.taskid, submissions.file, submissions.evaluated, submissions.userid,
+				EXTRACT(EPOCH FROM NOW() - submissions.time)::float, picked.low_priority, picked.urgent, picked.turn
+		''', {'worker': worker_id, 'lease': LEASE_SECONDS, 'count': count, 'urgent': list(urgent_task_ids)})
+		#dispatch in queue order
+		claimed = sorted(cursor.fetchall(), key=lambda s: (s[6], not s[7], s[8], s[0]))
+		return [s[:6] for s in claimed]
+
+	return run_transaction(work)
+
+def get_pending_tasks():
+	"""Get (id, path) of the tasks that have submissions waiting for evaluation."""
+	def work(cursor):
+		cursor.execute('''
+			SELECT id, path FROM tasks
+			WHERE id IN (SELECT taskid FROM submissions WHERE evaluated = false)
+		''')
+		return cursor.fetchall()
+
+	return run_transaction(work)
+
+def get_queue_depth():
+	"""Get (number of submissions waiting for evaluation, age of the oldest one in seconds)."""
+	def work(cursor):
+		cursor.execute('''
+			SELECT COUNT(*), COALESCE(EXTRACT(EPOCH FROM NOW() - MIN(time))::float, 0)
+			FROM submissions WHERE evaluated = false
+		''')
+		return cursor.fetchone()
+
+	return run_transaction(work)
+
+def renew_claims(submission_ids, worker_id=EVALUATOR_ID):
+	"""Extend the lease of submissions that are still being evaluated by <worker_id>."""
+	def work(cursor):
+		cursor.execute('UPDATE submissions SET claimed_at = NOW() WHERE id = ANY(%s) AND claimed_by = %s AND evaluated = false', (list(submission_ids), worker_id))
+
+	run_transaction(work)
+
+def release_claims(submission_ids, worker_id=EVALUATOR_ID):
+	"""Give up the claims of <worker_id>, so the submissions can be picked up again."""
+	def work(cursor):
+		cursor.execute('UPDATE submissions SET claimed_by = NULL, claimed_at = NULL WHERE id = ANY(%s) AND claimed_by = %s AND evaluated = false', (list(submission_ids), worker_id))
+
+	run_transaction(work)
 
 def get_task_files(task_ids):
 	"""Get task filenames"""
-	(db, cursor) = connect()
-	cursor.execute("SELECT id, path FROM tasks WHERE id IN (%s)" % (','.join(['%s'] * len(task_ids))), task_ids)
-	task_files = cursor.fetchall()
-	cursor.close()
-	db.close()
-	return task_files
+	def work(cursor):
+		cursor.execute('SELECT id, path FROM tasks WHERE id = ANY(%s)', (list(task_ids),))
+		return cursor.fetchall()
+
+	return run_transaction(work)
 
-def update_submission(submission_id):
-	(db, cursor) = connect()
+def _update_submission(cursor, submission_id):
 	cursor.execute("UPDATE submissions SET evaluated = true WHERE id = %s", (submission_id, ))
-	db.commit()
-	cursor.close()
-	db.close()
 
-def update_result(userid, taskid, score_last, result, result_file):
-	(db, cursor) = connect()
-	#update or insert
+def _update_result(cursor, submission_id, userid, taskid, score_last, result, result_file, source):
+	"""Store the result of <submission_id> unless a newer submission of the user already stored its result.
+
+	Results can be committed out of order when several workers or evaluators run in parallel, the
+	result of an older submission then only counts as a candidate for the best score."""
+	#score_best and best_source are set here (not by trigger_update_best_score from last_source),
+	#because last_source may already be the code of a newer pending submission
 	cursor.execute('''
-		INSERT INTO results (userid, taskid, score_last, result, result_file)
-		VALUES (%s, %s, %s, %s, %s)
+		INSERT INTO results (userid, taskid, score_last, result, result_file, submission_id, score_best, best_source)
+		VALUES (%(userid)s, %(taskid)s, %(score)s, %(result)s, %(result_file)s, %(submission_id)s,
+			CASE WHEN %(score)s > 0 THEN %(score)s END, CASE WHEN %(score)s > 0 THEN %(source)s END)
 		ON CONFLICT (userid, taskid) DO UPDATE SET
-		score_last = %s, result = %s, result_file = %s
-	''', (userid, taskid, score_last, result, result_file, score_last, result, result_file))
-	db.commit()
-	cursor.close()
-	db.close()
+		score_last = EXCLUDED.score_last, result = EXCLUDED.result, result_file = EXCLUDED.result_file, submission_id = EXCLUDED.submission_id,
+		score_best = CASE WHEN EXCLUDED.score_best IS NOT NULL AND (results.score_best IS NULL OR results.score_best < 0 OR EXCLUDED.score_best < results.score_best)
+			THEN EXCLUDED.score_best ELSE results.score_best END,
+		best_source = CASE WHEN EXCLUDED.score_best IS NOT NULL AND (results.score_best IS NULL OR results.score_best < 0 OR EXCLUDED.score_best < results.score_best)
+			THEN EXCLUDED.best_source ELSE results.best_source END
+		WHERE results.submission_id IS NULL OR results.submission_id <= EXCLUDED.submission_id
+	''', {'userid': userid, 'taskid': taskid, 'score': score_last, 'result': result, 'result_file': result_file, 'submission_id': submission_id, 'source': source})
+
+	if cursor.rowcount == 0 and score_last is not None and score_last > 0:
+		#a newer submission was evaluated first, only improve the best score
+		cursor.execute('''
+			UPDATE results SET score_best = %s, best_source = %s
+			WHERE userid = %s AND taskid = %s AND (score_best IS NULL OR score_best < 0 OR %s < score_best)
+		''', (score_last, source, userid, taskid, score_last))
+
+def _store_usage(cursor, submission_id, taskid, usage):
+	"""Store the resource usage of the runs of a submission (see qtrvsim.run_measured()), summed up per kind."""
+	summary = {}
+	for run in usage:
+		runs, wall, user, sys, maxrss = summary.get(run["kind"], (0, 0.0, 0.0, 0.0, 0))
+		summary[run["kind"]] = (runs + 1, wall + run["wall"], user + run["user"], sys + run["sys"], max(maxrss, run["maxrss"]))
+
+	for kind, (runs, wall, user, sys, maxrss) in summary.items():
+		cursor.execute('''
+			INSERT INTO resource_usage (submission_id, taskid, kind, runs, wall_seconds, user_seconds, sys_seconds, max_rss_kb)
+			VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+			ON CONFLICT (submission_id, kind) DO UPDATE SET
+			runs = EXCLUDED.runs, wall_seconds = EXCLUDED.wall_seconds, user_seconds = EXCLUDED.user_seconds,
+			sys_seconds = EXCLUDED.sys_seconds, max_rss_kb = EXCLUDED.max_rss_kb, created_at = NOW()
+		''', (submission_id, taskid, kind, runs, wall, user, sys, maxrss))
+
+def finish_submission(submission_id, userid, taskid, score_last, result, result_file, source, usage=()):
+	"""Mark the submission as evaluated and store its result and resource <usage> in a single transaction, see _update_result()."""
+	def work(cursor):
+		_update_submission(cursor, submission_id)
+		_update_result(cursor, submission_id, userid, taskid, score_last, result, result_file, source)
+		_store_usage(cursor, submission_id, taskid, usage)
+
+	run_transaction(work)
+
+def get_cached_result(key):
+	"""Get (score, result, result_file, eval_seconds) of a cached evaluation and count the hit, None on a miss.
+
+	<key> is (source_hash, task_digest, simulator_version, preprocessor_seed)."""
+	def work(cursor):
+		cursor.execute('''
+			UPDATE result_cache SET hits = hits + 1, last_hit_at = NOW()
+			WHERE source_hash = %s AND task_digest = %s AND simulator_version = %s AND preprocessor_seed = %s
+			RETURNING score, result, result_file, eval_seconds
+		''', key)
+		return cursor.fetchone()
+
+	return run_transaction(work)
+
+def store_cached_result(key, score, result, result_file, eval_seconds):
+	"""Store the result of an evaluation under <key>, see get_cached_result()."""
+	def work(cursor):
+		cursor.execute('''
+			INSERT INTO result_cache (source_hash, task_digest, simulator_version, preprocessor_seed, score, result, result_file, eval_seconds)
+			VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+			ON CONFLICT DO NOTHING
+		''', tuple(key) + (score, result, result_file, eval_seconds))
+
+	run_transaction(work)
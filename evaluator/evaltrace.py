@@ -0,0 +1,60 @@
+import os
+import json
+import time
+from datetime import datetime, timezone
+from contextlib import contextmanager
+
+# Append one JSON line per evaluated submission to this file, tracing is off when it is not set
+TRACE_FILE = os.getenv('EVAL_TRACE_FILE') or None
+
+class Trace:
+	def __init__(self, submission_id, task_id, queue_wait=None):
+		'''Durations of the stages of the evaluation of one submission.
+
+		Args:
+			submission_id (int): Id of the submission.
+			task_id (int): Id of the task.
+			queue_wait (float): Seconds between the submission and its claim.
+		'''
+		self.record = {
+			"submission": submission_id,
+			"task": task_id,
+			"claimed_at": datetime.now(timezone.utc).isoformat(),
+			"queue_wait": queue_wait,
+			"stages": {},
+			"testcases": [],
+		}
+		self.started = time.monotonic()
+
+	@contextmanager
+	def stage(self, name):
+		'''Measure the block as the stage <name>, repeated stages are summed up.'''
+		started = time.monotonic()
+		try:
+			yield
+		finally:
+			self.add(name, time.monotonic() - started)
+
+	def add(self, name, seconds):
+		'''Add <seconds> to the stage <name>.'''
+		stages = self.record["stages"]
+		stages[name] = stages.get(name, 0.0) + seconds
+
+	def add_testcases(self, timings):
+		'''Add the per-testcase timings of QtRVSim.timings.'''
+		self.record["testcases"] += timings
+
+	def write(self, result):
+		'''Finish the trace with the <result> code and append it to TRACE_FILE.'''
+		if TRACE_FILE is None:
+			return
+
+		self.record["result"] = result
+		self.record["total"] = time.monotonic() - self.started
+
+		#a single write of a whole line, so that the lines of several processes do not interleave
+		try:
+			with open(TRACE_FILE, 'a') as f:
+				f.write(json.dumps(self.record) + "\n")
+		except OSError as e:
+			print(f"  cannot write the trace: {e}")
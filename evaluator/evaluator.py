@@ -1,27 +1,89 @@
-import toml
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import time
+from collections import deque
 import evaldb as db
 from qtrvsim import QtRVSim
-from preprocessor import preprocess
+import taskcache
+import workspace
+import resultcache
+import buildcache
+import evaltrace
+import metrics
 import os
 import re
-import sys
+import select
+import threading
 import urllib.parse
 import traceback
 from dotenv import load_dotenv
 
 load_dotenv()
 
-TIMEOUT_TIME = 10 #seconds
+# Seconds a simulation may run when the task has no timeout and no calibrated budget (calibrate.py), also the limit of make
+TIMEOUT_TIME = float(os.getenv('EVAL_TIMEOUT') or 10)
 
 # Configurable directory for tasks
 TASKS_DIR = os.getenv('TASKS_DIR', '../web/tasks')
 
+# Number of submissions evaluated in parallel (one worker process each)
+EVAL_WORKERS = int(os.getenv('EVAL_WORKERS') or os.cpu_count() or 1)
+
+# Number of submissions of tasks with make or assemble_once built in parallel, see run_worker_pool()
+EVAL_BUILD_WORKERS = int(os.getenv('EVAL_BUILD_WORKERS') or EVAL_WORKERS)
+
+# Number of processes storing the results into the database
+EVAL_COMMIT_WORKERS = int(os.getenv('EVAL_COMMIT_WORKERS') or 1)
+
+# Stop at the first failed testcase, unless the task sets fail_fast itself
+EVAL_FAIL_FAST = os.getenv('EVAL_FAIL_FAST', '0') == '1'
+
+# Number of testcases of one submission simulated in parallel, by default the cores left per worker.
+# That is 1 with the default EVAL_WORKERS (one worker per core), lower EVAL_WORKERS to use it.
+EVAL_TESTCASE_WORKERS = int(os.getenv('EVAL_TESTCASE_WORKERS') or max(1, (os.cpu_count() or 1) // EVAL_WORKERS))
+
+# Submissions of tasks whose submit_end is less than this many hours away are evaluated first (0 disables it)
+EVAL_DEADLINE_HOURS = float(os.getenv('EVAL_DEADLINE_HOURS') or 24)
+
+# Skip pending submissions superseded by a newer one of the same user, unless the task sets coalesce itself
+EVAL_COALESCE = os.getenv('EVAL_COALESCE', '0') == '1'
+
+# Seconds the worker pool waits after a failed database call, doubled after every further failure
+EVAL_DB_RETRY_DELAY = float(os.getenv('EVAL_DB_RETRY_DELAY') or 1)
+
+def resolve_task_path(task_filename):
+	"""Resolve a task path stored in the database, relative paths are looked up in TASKS_DIR."""
+	if not os.path.isabs(task_filename):
+		return os.path.join(TASKS_DIR, os.path.basename(task_filename))
+	return task_filename
+
+def scheduling_hints():
+	"""Get (urgent, coalesced) ids of tasks with pending submissions, see db.claim_submissions().
+
+	Urgent tasks end in less than EVAL_DEADLINE_HOURS, coalesced tasks evaluate only the newest
+	pending submission of each user (task option coalesce, EVAL_COALESCE by default).
+	"""
+	now = datetime.now(timezone.utc)
+	urgent = []
+	coalesced = []
+	for task_id, task_filename in db.get_pending_tasks():
+		try:
+			task = taskcache.get_task(resolve_task_path(task_filename))
+		except Exception:
+			#a broken task file is reported by the evaluation itself
+			continue
+		if EVAL_DEADLINE_HOURS > 0 and task.submit_end is not None and now <= task.submit_end <= now + timedelta(hours=EVAL_DEADLINE_HOURS):
+			urgent.append(task_id)
+		if task.data.get('task', {}).get('coalesce', EVAL_COALESCE):
+			coalesced.append(task_id)
+	return (urgent, coalesced)
+
 def fetch_submissions(count):
-	"""Fetch the earliest <count> submissions from the database."""
+	"""Claim the next <count> pending submissions from the database, see db.claim_submissions()."""
 
-	submissions = db.get_latest_submissions(count)
+	urgent, coalesced = scheduling_hints()
+	submissions = db.claim_submissions(count, urgent, coalesced)
 
 	#for each taskid fetch its task filename
 
@@ -37,321 +99,769 @@ def fetch_submissions(count):
 	task_filenames = {task[0]: task[1] for task in task_filenames}
 
 	#resolve task filenames using TASKS_DIR
-	resolved_filenames = {}
-	for task_id, task_filename in task_filenames.items():
-		# If path is relative, use TASKS_DIR; if absolute, use as-is
-		if not os.path.isabs(task_filename):
-			resolved_filenames[task_id] = os.path.join(TASKS_DIR, os.path.basename(task_filename))
-		else:
-			resolved_filenames[task_id] = task_filename
-	task_filenames = resolved_filenames
+	task_filenames = {task_id: resolve_task_path(task_filename) for task_id, task_filename in task_filenames.items()}
 
 	return (submissions, task_filenames)
 
-def evaluate_submissions(num_submissions = 10):
-	fetch = fetch_submissions(num_submissions)
-	if fetch is None:
+def run_testcase(sim, testcase):
+	"""Configure the per-testcase evaluator <sim> for <testcase> and run it."""
+	#if flag is set or reference_regs are not empty, compare registers
+	if testcase.get("do_compare_registers", False) or testcase.get("reference_regs", None) != None:
+		#sim.set_do_compare_registers(True)
+		sim.set_reference_ending_regs(testcase["reference_regs"][0])
+
+	if testcase.get("do_compare_memory", False) or testcase.get("reference_mem", None) != None:
+		#sim.set_do_compare_memory(True)
+
+		mem = testcase["reference_mem"][0]
+		sim.set_reference_ending_memory(mem)
+
+	if testcase.get("do_set_starting_memory", False) or testcase.get("starting_mem", None) != None:
+		mem = testcase["starting_mem"][0]
+
+		sim.set_starting_memory(mem)
+
+	if testcase.get("do_compare_uart", False) or testcase.get("reference_uart", None) != None:
+		#sim.set_do_compare_uart(True)
+		uart = testcase["reference_uart"][0]
+		uart_string = uart.get("uart", None)
+		sim.set_reference_ending_uart(uart_string, "__uart.out")
+
+	if testcase.get("do_set_input_uart", False) or testcase.get("input_uart", None) != None:
+		uart = testcase["input_uart"][0]
+		uart_string = uart.get("uart", None)
+		sim.set_input_uart(uart_string, "__uart.in")
+
+	if testcase.get("private", False):
+		sim.set_private()
+
+	#run the evaluation
+	sim.log_test_name(testcase["name"])
+	sim.run(testcase["name"])
+	sim.log_test_result(testcase["name"])
+
+	return sim
+
+def run_testcases(sim, testcases, fail_fast=False):
+	"""Run <testcases> of the submission prepared in <sim>, up to EVAL_TESTCASE_WORKERS at once.
+
+	Returns (the per-testcase evaluators in testcase order, number of started testcases). Testcases
+	are started in order and only EVAL_TESTCASE_WORKERS ahead of the first unfinished one; after a
+	timeout (2) or an assembly error (5), or any failed testcase with <fail_fast>, no further
+	testcases are started and those already running are killed. Their results are dropped, only
+	their resource usage and timings are added to <sim>.
+
+	When a testcase raises, the finished testcases and the failed one are merged into <sim> before
+	the exception is re-raised, so that Job.fail() sees e.g. its assembly error.
+	"""
+	finished = []
+	cancelled = threading.Event()
+	with ThreadPoolExecutor(max_workers=EVAL_TESTCASE_WORKERS) as executor:
+		running = deque() #(future, testcase evaluator)
+		next_index = 0
+		try:
+			while next_index < len(testcases) or running:
+				while next_index < len(testcases) and len(running) < EVAL_TESTCASE_WORKERS:
+					testcase_sim = sim.testcase_sim(next_index)
+					testcase_sim.cancelled = cancelled
+					running.append((executor.submit(run_testcase, testcase_sim, testcases[next_index]), testcase_sim))
+					next_index += 1
+
+				future, testcase_sim = running.popleft()
+				try:
+					future.result()
+				except Exception:
+					for finished_sim in finished + [testcase_sim]:
+						sim.merge_testcase(finished_sim)
+					raise
+				finished.append(testcase_sim)
+
+				if testcase_sim.get_result() in (2, 5) or (fail_fast and testcase_sim.get_result() != 0):
+					break
+		finally:
+			cancelled.set()
+			for future, stopped_sim in running:
+				try:
+					future.result()
+				except Exception:
+					pass
+				for timing in stopped_sim.timings:
+					timing["cancelled"] = True
+				sim.merge_usage(stopped_sim)
+
+	return (finished, next_index)
+
+def task_files(task_data):
+	"""Get {file name: content} of the static files of a task, the [[files]] and the Makefile."""
+	files = {file["name"]: file["code"] for file in task_data.get("files", None) or []}
+	if task_data.get("make", None) != None:
+		files["Makefile"] = task_data["make"].get("Makefile", None)
+	return files
+
+def prebuild_function(task_data):
+	"""Get the build function of the task template, None if the task has no [make] prebuild targets."""
+	targets = (task_data.get("make", None) or {}).get("prebuild", [])
+	if not targets:
 		return None
-	
-	submissions, task_filenames = fetch
 
-	for s in submissions:
-		#get arguments from task toml file
+	def build(directory):
+		sim = QtRVSim(working_dir=directory)
+		sim.make_timeout_time = TIMEOUT_TIME
+		sim.run_make(targets)
+		if not sim.makefile_successfull:
+			print(f"  prebuild of {targets} failed: {sim.makefile_log}")
+		return sim.makefile_successfull
+
+	return build
+
+def use_task_template(sim, task_id, task, task_data):
+	"""Fill the working directory of <sim> from the prepared template of the task <task_id>.
+
+	The template holds the static files (and prebuilt objects) of the task and is created once per
+	version of the task file, jobs only link them. Returns False when the files have to be written
+	by the caller, i.e. the preprocessor generates different files for every evaluation or the
+	template cannot be used.
+	"""
+	files = task_files(task_data)
+	if not files or not task.deterministic:
+		return False
+
+	try:
+		template = workspace.prepare_template(sim.working_dir, str(task_id), task.digest[:16], files, prebuild_function(task_data))
+		workspace.populate(sim.working_dir, template)
+	except OSError as e:
+		print(f"  cannot use the task template: {e}")
+		return False
+
+	if "Makefile" in files:
+		sim.makefile_present = True
+	return True
+
+class Job:
+	def __init__(self, s, task_filename, job_dir):
+		"""State of the evaluation of submission <s>, passed between the build, simulate and commit stages.
+
+		Args:
+			s (tuple): The claimed submission (id, taskid, file, evaluated, userid[, seconds since the submission]).
+			task_filename (str): Path to the task file.
+			job_dir (str): Workspace of the job, removed by the commit stage.
+		"""
+		self.s = s
+		self.task_filename = task_filename
+		self.job_dir = job_dir
+
+		self.task_data = None
+		self.sim = None
+		self.filepath = ""
+		self.error_log = ""
+		self.cache_exit = False
+		self.make_exit = False
+		self.makefile_present = False
+		self.cache_key = None
+		self.cache_hits = {} #cache name -> whether the lookup was a hit
+		self.started = time.monotonic()
+
+		self.trace = evaltrace.Trace(s[0], s[1], s[5] if len(s) > 5 else None)
+		self.queued_at = time.monotonic() #when the job was put into the queue of its next stage
+
+		self.built = False
+		self.outcome = None #(score, was_accepted, log) once the evaluation is decided
+		self.store_outcome = False #whether the outcome goes into the result cache
+		self.use_budget = True #whether the calibrated budget of the task applies, not when calibrating it
+
+	def build(self):
+		"""Write the sources into the workspace and run make (or assemble them once)."""
+		s = self.s
 		task_id = s[1] #task id
-		arguments = []
-		was_accepted = 1 #was not accepted
-		cache_exit = False
-		make_exit = False
-		filepath = ""
-
-		try:
-			with open(task_filenames[task_id]) as f:
-				preprocessed = preprocess(f)
-				task_data = toml.loads(preprocessed)
-				print(task_data)
-				#task_data = toml.load(f)
-
-				cache_max_size = task_data["task"].get("cache_max_size", -1)
-				is_c_solution = task_data["task"].get("c_solution", False)
-
-				#get PID of the running evaluator
-				pid = os.getpid()
-				#save file into /tmp/qtrvsim_web_eval/_job_PID/submission.S
-				filepath = f"/tmp/qtrvsim_web_eval/_job_{pid}/submission.S"
-				#make the directory if it does not exist
-				if is_c_solution:
-					filepath = f"/tmp/qtrvsim_web_eval/_job_{pid}/submission.c"
-
-				os.makedirs(os.path.dirname(filepath), exist_ok=True)
-				#save the file from s[2] to filepath
-				with open(filepath, 'w') as f:
-					f.write(s[2])
-
-				error_log = ""
-				if cache_max_size > 0:
-					#read first line of the submission file
-					with open(filepath, 'r') as f:
-						lines = f.readlines()
-					
-					#cache settings should be in format 
-					#policy,sets,words_in_block,ways,write_method, where policy is either random, lru, lfu
-					#for example:
-					#lru,1,1,1,wb
-					#the line should be in exact format #pragma cache:lru,1,1,1,wb
-					
-					d_cache_par = None
-
-					for line in lines:
-						if line.startswith('#pragma cache:'):
-							d_cache_par = line.replace('#pragma cache:', '').strip()
-							break
-
-					# Check if the cache parameters line was found
-					if d_cache_par == None:
-						error_log += "Error: cache parameters line not found\nUse:\n\n#pragma cache:policy,sets,words_in_block,ways,write_method\n\nsomewhere in your file to set these parameters.\n"
-						error_log += "policy is either random, lru, lfu\n"
-						error_log += f"maximum cache size for this task is {cache_max_size} bytes\n"
-						cache_exit = True
-
-					# Check if the parameters can be parsed
-					if not cache_exit:
-						match = re.match(r'^(lru|lfu|random),\d+,\d+,\d+,(wb|wt)$', d_cache_par)
-						if not match:
-							error_log += f"Error: cache parameters line not in the correct format {d_cache_par}\n"
-							error_log += "Use:\n\n#pragma cache:policy,sets,words_in_block,ways,write_method\n\n"
-							error_log += "policy is either random, lru, lfu\n"
-							error_log += f"maximum cache size for this task is {cache_max_size} bytes\n"
-							cache_exit = True
-
-					d_cache_size_ok = False
-
-					if not cache_exit:
-						# Extract the numbers from the parameters and perform the calculation
-						numbers = [int(num) for num in re.findall(r'\d+', d_cache_par)]
-						if len(numbers) >= 3:
-							d_cache_size_ok = numbers[0] * numbers[1] * numbers[2] <= cache_max_size
-							
-					# Check if the calculation result is 1
-					if not d_cache_size_ok and not cache_exit:
-						error_log += f"Error: cache size is too big {d_cache_par}\n"
-						error_log += f"maximum cache size for this task is {cache_max_size} bytes\n"
-						cache_exit = True
-
-					if not cache_exit:
-						# Set the cache parameters
-						task_data["arguments"]["run"] += f' --d-cache {d_cache_par}'
+		with self.trace.stage("task_load"):
+			task = taskcache.get_task(self.task_filename)
+
+		#identical code was already evaluated against the same task, reuse the result
+		with self.trace.stage("result_cache"):
+			self.cache_key = resultcache.make_key(s[2], task)
+			cached = resultcache.lookup(self.cache_key)
+		if self.cache_key is not None:
+			self.cache_hits["result"] = cached is not None
+		if cached is not None:
+			score, was_accepted, log = cached
+			print(f"  submission {s[0]} taken from cache, accepted: {was_accepted}, cycles: {score} ({resultcache.report()})")
+			self.outcome = (score, was_accepted, log)
+			return
+
+		with self.trace.stage("preprocess"):
+			task_data = task.instantiate()
+		self.task_data = task_data
+
+		cache_max_size = task_data["task"].get("cache_max_size", -1)
+		is_c_solution = task_data["task"].get("c_solution", False)
+
+		#save file into <workspace root>/_job_ID_XXXX/submission.S
+		filepath = os.path.join(self.job_dir, "submission.S")
+		if is_c_solution:
+			filepath = os.path.join(self.job_dir, "submission.c")
+		self.filepath = filepath
+
+		#save the file from s[2] to filepath
+		with self.trace.stage("staging"):
+			workspace.write_file(filepath, s[2])
+
+		error_log = ""
+		if cache_max_size > 0:
+			#read first line of the submission file
+			with open(filepath, 'r') as f:
+				lines = f.readlines()
+			
+			#cache settings should be in format 
+			#policy,sets,words_in_block,ways,write_method, where policy is either random, lru, lfu
+			#for example:
+			#lru,1,1,1,wb
+			#the line should be in exact format #pragma cache:lru,1,1,1,wb
+			
+			d_cache_par = None
+
+			for line in lines:
+				if line.startswith('#pragma cache:'):
+					d_cache_par = line.replace('#pragma cache:', '').strip()
+					break
+
+			# Check if the cache parameters line was found
+			if d_cache_par == None:
+				error_log += "Error: cache parameters line not found\nUse:\n\n#pragma cache:policy,sets,words_in_block,ways,write_method\n\nsomewhere in your file to set these parameters.\n"
+				error_log += "policy is either random, lru, lfu\n"
+				error_log += f"maximum cache size for this task is {cache_max_size} bytes\n"
+				self.cache_exit = True
+
+			# Check if the parameters can be parsed
+			if not self.cache_exit:
+				match = re.match(r'^(lru|lfu|random),\d+,\d+,\d+,(wb|wt)$', d_cache_par)
+				if not match:
+					error_log += f"Error: cache parameters line not in the correct format {d_cache_par}\n"
+					error_log += "Use:\n\n#pragma cache:policy,sets,words_in_block,ways,write_method\n\n"
+					error_log += "policy is either random, lru, lfu\n"
+					error_log += f"maximum cache size for this task is {cache_max_size} bytes\n"
+					self.cache_exit = True
+
+			d_cache_size_ok = False
+
+			if not self.cache_exit:
+				# Extract the numbers from the parameters and perform the calculation
+				numbers = [int(num) for num in re.findall(r'\d+', d_cache_par)]
+				if len(numbers) >= 3:
+					d_cache_size_ok = numbers[0] * numbers[1] * numbers[2] <= cache_max_size
 					
+			# Check if the calculation result is 1
+			if not d_cache_size_ok and not self.cache_exit:
+				error_log += f"Error: cache size is too big {d_cache_par}\n"
+				error_log += f"maximum cache size for this task is {cache_max_size} bytes\n"
+				self.cache_exit = True
+
+			if not self.cache_exit:
+				# Set the cache parameters
+				task_data["arguments"]["run"] += f' --d-cache {d_cache_par}'
+			
+
+		sim = QtRVSim(submission_file=filepath, working_dir=os.path.dirname(filepath))
+		self.sim = sim
+		#sim.set_verbose(True)
 
-				num_testcases = len(task_data['testcases'])
-				sim = QtRVSim(submission_file=filepath, working_dir=os.path.dirname(filepath))
-				#sim.set_verbose(True)
-	
-				sim.set_args(args=task_data["arguments"]["run"])
+		sim.set_args(args=task_data["arguments"]["run"])
 
-				if task_data["task"].get("scoring_expression", None) != None:
-					sim.set_scoring_expr(task_data["task"]["scoring_expression"])
+		#limits calibrated from the reference solution, a timeout of the task file takes precedence
+		budget = task.budget if self.use_budget else {}
+		sim.timeout_time = task_data["task"].get("timeout", budget.get("timeout", TIMEOUT_TIME))
+		sim.make_timeout_time = TIMEOUT_TIME
+		#the --cycle-limit of the task file is the hard cap, the calibrated one lowers it only when the task asks for it
+		cycle_limit = budget.get("cycle_limit", None)
+		if cycle_limit is not None and not sim.cycle_limit_set:
+			sim.set_args(args=f'{task_data["arguments"]["run"]} --cycle-limit {cycle_limit}')
+		elif cycle_limit is not None and cycle_limit < sim.cycle_limit and task_data["task"].get("calibrated_cycle_limit", False):
+			sim.set_args(args=re.sub(r"--cycle-limit \d+", f"--cycle-limit {cycle_limit}", task_data["arguments"]["run"]))
 
-				score = 0
-				tests_passed = 0
-				timed_out = False
-				assembly_error = False
-				makefile_present = False
+		if task_data["task"].get("scoring_expression", None) != None:
+			sim.set_scoring_expr(task_data["task"]["scoring_expression"])
 
+		with self.trace.stage("staging"):
+			if not use_task_template(sim, task_id, task, task_data):
 				if task_data.get("files", None) != None:
 					
 					for file in task_data["files"]:
 						sim.create_file(file["name"], file["code"])
 
 				if task_data.get("make", None) != None:
-					makefile_present = True
-					Makefile = task_data["make"].get("Makefile", None)
-						
-					sim.create_makefile(Makefile)
-					sim.run_make()
-
-					if not sim.makefile_successfull:
-						make_exit = True
-						error_log += "Error: makefile failed\n"
-						error_log += sim.makefile_log
-
-				for i in range(num_testcases):
-					if cache_exit or make_exit:
-						break
-					#if flag is set or reference_regs are not empty, compare registers
-					if task_data["testcases"][i].get("do_compare_registers", False) or task_data["testcases"][i].get("reference_regs", None) != None:
-						#sim.set_do_compare_registers(True)
-						sim.set_reference_ending_regs(task_data["testcases"][i]["reference_regs"][0])
+					sim.create_makefile(task_data["make"].get("Makefile", None))
+
+		if task_data.get("make", None) != None:
+			self.makefile_present = True
+			#identical sources were already built, e.g. by a resubmission or for another version of the task
+			build_key = buildcache.make_key(os.path.basename(filepath), s[2], task_files(task_data))
+			with self.trace.stage("make"):
+				restored = buildcache.run_make(sim, build_key)
+			if build_key is not None:
+				self.cache_hits["build"] = restored
+
+			if not sim.makefile_successfull:
+				self.make_exit = True
+				error_log += "Error: makefile failed\n"
+				error_log += sim.makefile_log
+
+		elif task_data["task"].get("assemble_once", False) and not is_c_solution:
+			with self.trace.stage("assemble"):
+				sim.assemble()
+
+		self.error_log = error_log
+
+	def simulate(self):
+		"""Run the testcases of the built submission and decide the outcome."""
+		s = self.s
+		sim = self.sim
+		task_data = self.task_data
+		cache_exit = self.cache_exit
+		make_exit = self.make_exit
+		error_log = self.error_log
+
+		num_testcases = len(task_data['testcases'])
+		was_accepted = 1 #was not accepted
+		score = 0
+		tests_passed = 0
+		timed_out = False
+		assembly_error = False
 
-					if task_data["testcases"][i].get("do_compare_memory", False) or task_data["testcases"][i].get("reference_mem", None) != None:
-						#sim.set_do_compare_memory(True)
+		testcases = [] if cache_exit or make_exit else task_data['testcases']
+		fail_fast = task_data["task"].get("fail_fast", EVAL_FAIL_FAST)
 
-						mem = task_data["testcases"][i]["reference_mem"][0]
-						sim.set_reference_ending_memory(mem)
+		with self.trace.stage("simulate"):
+			finished, started = run_testcases(sim, testcases, fail_fast)
 
-					if task_data["testcases"][i].get("do_set_starting_memory", False) or task_data["testcases"][i].get("starting_mem", None) != None:
-						mem = task_data["testcases"][i]["starting_mem"][0]
+		for i, testcase_sim in enumerate(finished):
+			sim.merge_testcase(testcase_sim)
 
-						sim.set_starting_memory(mem)
+			if sim.get_result() == 0:
+				tests_passed += 1
 
-					if task_data["testcases"][i].get("do_compare_uart", False) or task_data["testcases"][i].get("reference_uart", None) != None:
-						#sim.set_do_compare_uart(True)
-						uart = task_data["testcases"][i]["reference_uart"][0]
-						uart_string = uart.get("uart", None)
-						sim.set_reference_ending_uart(uart_string, "__uart.out")
+			if sim.get_result() == 2: #do not evaluate further testcases if one timed out
+				timed_out = True
+				break
 
-					if task_data["testcases"][i].get("do_set_input_uart", False) or task_data["testcases"][i].get("input_uart", None) != None:
-						uart = task_data["testcases"][i]["input_uart"][0]
-						uart_string = uart.get("uart", None)
-						sim.set_input_uart(uart_string, "__uart.in")
+			if sim.get_result() == 5: #qtrvsim.py error code for integrated assembly error
+				assembly_error = True
+				break
 
-					if task_data["testcases"][i].get("private", False):
-						sim.set_private()
+			if fail_fast and sim.get_result() != 0: #the submission cannot be accepted anymore
+				stopped = started - len(finished)
+				sim.log += f"\nEvaluation stopped after the first failed testcase, {len(testcases) - started} remaining testcases were not run" + (f" and {stopped} running ones were stopped" if stopped else "") + ".\n"
+				break
+		
+		if tests_passed == num_testcases and not cache_exit and not make_exit:
+			was_accepted = 0 #mark as accepted
 
-					#run the evaluation
-					sim.log_test_name(task_data["testcases"][i]["name"])
-					sim.run(task_data["testcases"][i]["name"])
-					sim.log_test_result(task_data["testcases"][i]["name"])
+			scoring_testcase = sim.results[task_data["score"]["testcase"]]
+			score = scoring_testcase[1] #TODO: can be changed to cache, now is set to cycles
 
+		if timed_out:
+			score = -1
+			was_accepted = 2
 
-					if sim.get_result() == 0:
-						tests_passed += 1
+		if assembly_error:
+			raise Exception("Error in integrated assembly")
 
-					if sim.get_result() == 2: #do not evaluate further testcases if one timed out
-						timed_out = True
-						break
+		if not cache_exit and not make_exit:
+			#the files are removed together with the job directory
+			sim.end_eval(task_data["score"]["testcase"], clear_files=False)
 
-					if sim.get_result() == 5: #qtrvsim.py error code for integrated assembly error
-						assembly_error = True
-						break
 
-					sim.reset()
-				
-				if tests_passed == num_testcases and not cache_exit and not make_exit:
-					was_accepted = 0 #mark as accepted
+		if cache_exit:
+			score = -1
+			was_accepted = 3
+			sim.log = error_log
 
-					scoring_testcase = sim.results[task_data["score"]["testcase"]]
-					score = scoring_testcase[1] #TODO: can be changed to cache, now is set to cycles
+		if make_exit:
+			score = -1
+			was_accepted = 4
+			sim.log = error_log
 
-				if timed_out:
-					score = -1
-					was_accepted = 2
+		print(f"  submission {s[0]} evaluated, accepted: {was_accepted}, cycles: {score}" + (f" ({buildcache.report()})" if self.makefile_present else ""))
+		#print(sim.get_log())
 
-				if assembly_error:
-					raise Exception("Error in integrated assembly")
+		self.outcome = (score, was_accepted, sim.get_log())
+		self.store_outcome = not sim.makefile_timed_out
 
-				if not cache_exit and not make_exit:
-					sim.end_eval(task_data["score"]["testcase"])
+	def fail(self, e):
+		"""Decide the outcome after the exception <e>, must be called from the except block."""
+		s = self.s
+		sim = self.sim
+		filepath = self.filepath
+		try:
+			if sim is not None and sim.get_result() == 5: #qtrvsim.py error code for integrated assembly error
+				error_log = f"An error occurred during evaluation:\n"
+				error_log += f"Error in integrated assembly.\n"
+				
+				#TODO: enable this line to show the stdout to the user
+				#error_log += f"{sim.error_log}\n"
+				
+				#/_job_19596/submission.S:17:error:unknown instruction
 
+				#parsing the error line numbers
+				#error_line_num = re.match(r'.*:(\d+):.*', sim.error_log)
+				#error_line_num = error_line_num.group(1) if error_line_num else "?"
 
-			if cache_exit:
-				score = -1
-				was_accepted = 3
-				sim.log = error_log
+				error_line_nums = re.findall(r'.*:(\d+):error:.*', sim.error_log, re.MULTILINE)
+				error_line_nums = [int(num) for num in error_line_nums]
 
-			if make_exit:
-				score = -1
-				was_accepted = 4
-				sim.log = error_log
+				error_types = re.findall(r'.*:\d+:error:(.*)$', sim.error_log, re.MULTILINE)
 
-			if makefile_present:
-				sim.run_make_clean()
-				os.remove(os.path.join(os.path.dirname(filepath), "Makefile"))
+				error_lines = []
+				if os.path.exists(filepath):
+					with open(filepath, 'r') as f:
+						lines = f.readlines()
+						for num in error_line_nums:
+							error_lines.append(lines[num-1].strip())
 
-			print(f"  submission {s[0]} evaluated, accepted: {was_accepted}, cycles: {score}")
-			#print(sim.get_log())
+				for i, err in enumerate(error_lines):
+					if len(error_types) > i and len(error_line_nums) > i:
+						error_log += f"On line {error_line_nums[i]} in your code:\n"
+						error_log += f"{error_types[i]}\nhere -->" + err + "\n"
 
-			#TODO: commit changes to database
-			db.update_submission(s[0])
+				#error_log += f"On line {error_line_num} in your code:\n"
+				#error_log += error_lines[0] if len(error_lines) > 0 else "\n"
+				#error_log += "here -->" + error_lines[1] if len(error_lines) > 1 else "\n"
+				#error_log += error_lines[2] if len(error_lines) > 2 else "\n"
 
-			db.update_result(s[4], s[1], score, was_accepted, sim.get_log())
-			
-			#TODO: remove the directory after evaluation
-			
-			#remove submission.S and __ending_mem__ and __starting_mem__ files
-			
-			try:
-				os.remove(filepath)
-			except OSError as e:
-				print(f"Error: {e.filename} - {e.strerror}.")
+				error_log += f"\nPlease check your code and try again."
+				#error_log += f"\nPlease note, that %lo and %hi are not yet supported in the integrated assembly, and will thus throw an assembly error when no Makefile for compilation is present at the task.\n"
 
-			try:
-				os.rmdir(os.path.dirname(filepath))  # if not empty will not be deleted
-			except OSError as e:
-				print(f"Error: {e.filename} - {e.strerror}.")
+				self.outcome = (-1, 5, error_log)
+				self.store_outcome = True
 
-			#wait for a second
-			time.sleep(1)
+			else:
+				raise e
 
 		except Exception as e:
-			try:
-				if sim.get_result() == 5: #qtrvsim.py error code for integrated assembly error
-					error_log = f"An error occurred during evaluation:\n"
-					error_log += f"Error in integrated assembly.\n"
-					
-					#TODO: enable this line to show the stdout to the user
-					#error_log += f"{sim.error_log}\n"
-					
-					#/_job_19596/submission.S:17:error:unknown instruction
-
-					#parsing the error line numbers
-					#error_line_num = re.match(r'.*:(\d+):.*', sim.error_log)
-					#error_line_num = error_line_num.group(1) if error_line_num else "?"
-
-					error_line_nums = re.findall(r'.*:(\d+):error:.*', sim.error_log, re.MULTILINE)
-					error_line_nums = [int(num) for num in error_line_nums]
+			print(f"Error: {e}")
+			error_log = f"An error occurred during evaluation:\n"
+			error_log += f"{type(e).__name__}\n"
+			error_log += f"Message: {e}\n"
+			error_log += f"Traceback: {traceback.format_exc()}\n"
+			error_log += f"Please create an issue with this error on GitLab: https://gitlab.fel.cvut.cz/b35apo/qtrvsim-eval-web/-/issues/new?issue[title]=Error%20in%20evaluator%20uid%20{s[4]}%20tid{s[1]}&issue[description]={type(e).__name__}%0A{urllib.parse.quote(str(traceback.format_exc()), safe='')}%0A{urllib.parse.quote(str(e), safe='')}"
+
+			self.outcome = (-1, 99, error_log)
+			self.store_outcome = False
+
+	def commit(self):
+		"""Store the outcome in the database and the result cache."""
+		s = self.s
+		score, was_accepted, log = self.outcome
+		usage = self.sim.usage if self.sim is not None else []
+
+		with self.trace.stage("commit"):
+			db.finish_submission(s[0], s[4], s[1], score, was_accepted, log, s[2], usage)
+
+			if self.store_outcome:
+				resultcache.store(self.cache_key, score, was_accepted, log, time.monotonic() - self.started)
+
+		if self.sim is not None:
+			self.trace.add_testcases(self.sim.timings)
+		self.trace.write(was_accepted)
+
+	def start_stage(self, name):
+		"""Record how long the job waited in the queue of the stage <name>."""
+		self.trace.add(f"{name}_queue", time.monotonic() - self.queued_at)
+
+	def end_stage(self):
+		"""Mark the job as queued for its next stage."""
+		self.queued_at = time.monotonic()
+
+def needs_build_stage(task_filename):
+	"""Check whether the build of submissions of the task takes long (make or assemble_once).
+
+	Other submissions are built by the simulate stage, so they never wait behind heavy builds."""
+	try:
+		task_data = taskcache.get_task(task_filename).data
+	except Exception:
+		#the error is reported by the evaluation
+		return False
+	return task_data.get("make", None) != None or task_data.get("task", {}).get("assemble_once", False)
+
+def build_stage(job):
+	"""Build stage of the pipeline, returns the <job>."""
+	job.start_stage("build")
+	try:
+		job.build()
+	except Exception as e:
+		job.fail(e)
+	job.built = True
+	job.end_stage()
+	return job
+
+def simulate_stage(job):
+	"""Simulate stage of the pipeline, also builds jobs that skipped the build stage. Returns the <job>."""
+	if not job.built:
+		build_stage(job)
+
+	job.start_stage("simulate")
+	if job.outcome is None:
+		try:
+			job.simulate()
+		except Exception as e:
+			job.fail(e)
+	job.end_stage()
+	return job
+
+def commit_stage(job):
+	"""Commit stage of the pipeline, stores the outcome and removes the workspace of the <job>."""
+	job.start_stage("commit")
+	try:
+		job.commit()
+	finally:
+		#the whole job directory is removed, including make artifacts
+		workspace.remove(job.job_dir)
+	return job
+
+def record_metrics(job):
+	"""Count the <job> that went through the commit stage in the metrics of this process."""
+	metrics.inc('webeval_evaluator_submissions_total', (("result", job.outcome[1]),))
+
+	for cache, hit in job.cache_hits.items():
+		metrics.inc('webeval_evaluator_cache_lookups_total', (("cache", cache),))
+		if hit:
+			metrics.inc('webeval_evaluator_cache_hits_total', (("cache", cache),))
+
+	if job.sim is not None:
+		for timing in job.sim.timings:
+			if timing.get("cancelled", False):
+				continue
+			metrics.observe('webeval_evaluator_testcase_simulation_seconds', timing["simulate"])
+
+def update_queue_metrics(stages):
+	"""Refresh the gauges of the database queue and of the jobs in the pipeline <stages>."""
+	depth, oldest = db.get_queue_depth()
+	metrics.set_gauge('webeval_evaluator_queue_depth', depth)
+	metrics.set_gauge('webeval_evaluator_oldest_pending_seconds', oldest)
+
+	for stage in stages:
+		metrics.set_gauge('webeval_evaluator_jobs', len(stage), (("stage", stage.name),))
+
+def open_listener():
+	"""Subscribe to new submission notifications, returns None if it is not possible right now."""
+	try:
+		return db.listen()
+	except Exception as e:
+		print(f"  cannot listen for new submissions, polling only: {e}")
+		return None
 
-					error_types = re.findall(r'.*:\d+:error:(.*)$', sim.error_log, re.MULTILINE)
+def wait_for_event(listener, wakeup_fd, timeout):
+	"""Block until a submission is inserted, a worker finishes or <timeout> seconds pass.
 
-					error_lines = []
-					if os.path.exists(filepath):
-						with open(filepath, 'r') as f:
-							lines = f.readlines()
-							for num in error_line_nums:
-								error_lines.append(lines[num-1].strip())
+	Returns the listener, which is None when its connection was lost.
+	"""
+	readers = [wakeup_fd] if listener is None else [wakeup_fd, listener]
 
-					for i, err in enumerate(error_lines):
-						if len(error_types) > i and len(error_line_nums) > i:
-							error_log += f"On line {error_line_nums[i]} in your code:\n"
-							error_log += f"{error_types[i]}\nhere -->" + err + "\n"
+	try:
+		ready, _, _ = select.select(readers, [], [], timeout)
 
-					#error_log += f"On line {error_line_num} in your code:\n"
-					#error_log += error_lines[0] if len(error_lines) > 0 else "\n"
-					#error_log += "here -->" + error_lines[1] if len(error_lines) > 1 else "\n"
-					#error_log += error_lines[2] if len(error_lines) > 2 else "\n"
+		if wakeup_fd in ready:
+			os.read(wakeup_fd, 4096)
 
-					error_log += f"\nPlease check your code and try again."
-					#error_log += f"\nPlease note, that %lo and %hi are not yet supported in the integrated assembly, and will thus throw an assembly error when no Makefile for compilation is present at the task.\n"
+		if listener is not None and listener in ready:
+			listener.poll()
+			listener.notifies.clear()
+	except Exception as e:
+		print(f"  lost the notification connection: {e}")
+		try:
+			listener.close()
+		except Exception:
+			pass
+		listener = None
+
+	return listener
+
+class Stage:
+	def __init__(self, name, function, workers):
+		"""Pipeline stage with its own worker processes and queue.
+
+		Args:
+			name (str): Name of the stage for the log.
+			function (callable): Module level function run in the workers, gets and returns a Job.
+			workers (int): Number of jobs the stage runs at once.
+		"""
+		self.name = name
+		self.function = function
+		self.workers = workers
+		self.pool = ProcessPoolExecutor(max_workers=workers)
+		self.queue = deque() #jobs waiting for a worker
+		self.running = {} #future -> job
+
+	def __len__(self):
+		return len(self.queue) + len(self.running)
+
+	def put(self, job):
+		self.queue.append(job)
+
+	def dispatch(self, wakeup_w):
+		"""Start queued jobs while there are free workers, finished jobs write into <wakeup_w>."""
+		while self.queue and len(self.running) < self.workers:
+			job = self.queue.popleft()
+			future = self.pool.submit(self.function, job)
+			future.add_done_callback(lambda _: os.write(wakeup_w, b'.'))
+			self.running[future] = job
+
+	def collect(self):
+		"""Return (job, exception) of the finished jobs, the job is the one returned by the worker if it succeeded."""
+		finished = []
+		for future, job in list(self.running.items()):
+			if future.done():
+				del self.running[future]
+				if future.exception() is None:
+					finished.append((future.result(), None))
+				else:
+					finished.append((job, future.exception()))
+		return finished
+
+	def restart(self):
+		"""Replace a broken pool, returns the jobs that were still running in it. Queued jobs are kept."""
+		print(f"  {self.name} pool is broken, restarting it")
+		jobs = list(self.running.values())
+		self.running = {}
+		self.pool.shutdown(wait=False, cancel_futures=True)
+		self.pool = ProcessPoolExecutor(max_workers=self.workers)
+		return jobs
+
+class Backoff:
+	def __init__(self, limit):
+		"""Delay of database calls after failures, from EVAL_DB_RETRY_DELAY doubling up to <limit> seconds."""
+		self.limit = limit
+		self.delay = 0.0
+		self.retry_at = 0.0
+
+	def ready(self):
+		return time.monotonic() >= self.retry_at
+
+	def remaining(self):
+		return max(0.0, self.retry_at - time.monotonic())
+
+	def succeeded(self):
+		self.delay = 0.0
+
+	def failed(self, what, exception):
+		self.delay = min(self.limit, self.delay * 2 or EVAL_DB_RETRY_DELAY)
+		self.retry_at = time.monotonic() + self.delay
+		print(f"  {what} failed, retrying in {self.delay:g} s: {exception}")
+
+def run_worker_pool(num_workers = EVAL_WORKERS, interval = 30):
+	"""Keep the build, simulate and commit stages busy with submissions.
+
+	Submissions of tasks with a heavy build (make or assemble_once) go through the build stage
+	(EVAL_BUILD_WORKERS processes) first, the others straight to the simulate stage (<num_workers>
+	processes), so slow compilations never block simulations. Finished evaluations are stored by
+	the commit stage (EVAL_COMMIT_WORKERS processes). Whenever a stage has room or a new submission
+	is inserted (LISTEN/NOTIFY), more submissions are claimed. Polling every <interval> seconds
+	is only a fallback for missed notifications and expired leases. When the database is not
+	reachable, the running jobs are still collected and the database calls are retried later.
+	"""
+	print(f"Starting evaluator {db.EVALUATOR_ID} with {EVAL_BUILD_WORKERS} build, {num_workers} simulate and {EVAL_COMMIT_WORKERS} commit worker(s)")
+
+	build = Stage("build", build_stage, EVAL_BUILD_WORKERS)
+	simulate = Stage("simulate", simulate_stage, num_workers)
+	commit = Stage("commit", commit_stage, EVAL_COMMIT_WORKERS)
+	next_stage = {build: simulate, simulate: commit, commit: None}
+
+	in_flight = {} #submission id -> job
+	unreleased = [] #ids of failed submissions still claimed in the database
+	last_renewal = time.monotonic()
+	backoff = Backoff(interval)
+	#a broken metrics query must not delay the evaluations
+	metrics_backoff = Backoff(interval)
+
+	#finished futures write into this pipe, so that the main loop can select() on it
+	wakeup_r, wakeup_w = os.pipe()
+	os.set_blocking(wakeup_r, False)
+
+	listener = open_listener()
+	metrics_enabled = metrics.start_server()
 
-					db.update_submission(s[0])
-					db.update_result(s[4], s[1], -1, 5, error_log)
+	while True:
+		for stage in (build, simulate, commit):
+			failed = []
+			pool_broken = False
+			for job, exception in stage.collect():
+				if exception is None:
+					if next_stage[stage] is not None:
+						next_stage[stage].put(job)
+					else:
+						del in_flight[job.s[0]]
+						record_metrics(job)
+					continue
+
+				print(f"  submission {job.s[0]} failed in {stage.name} worker: {exception}")
+				failed.append(job)
+				pool_broken = pool_broken or isinstance(exception, BrokenProcessPool)
+
+			if pool_broken:
+				#a worker process died, the executor cannot be used anymore
+				failed += stage.restart()
+
+			for job in failed:
+				#put the submission back into the queue for another attempt
+				workspace.remove(job.job_dir)
+				del in_flight[job.s[0]]
+				unreleased.append(job.s[0])
+
+		if unreleased and backoff.ready():
+			try:
+				db.release_claims(unreleased)
+				metrics.inc('webeval_evaluator_released_total', value=len(unreleased))
+				unreleased = []
+				backoff.succeeded()
+			except Exception as e:
+				#the leases expire anyway, the release is only faster
+				backoff.failed("releasing claims", e)
 
-				else:
-					raise e
+		#every stage can hold as many jobs as it has workers
+		free_slots = build.workers + simulate.workers + commit.workers - len(in_flight)
 
+		if free_slots > 0 and backoff.ready():
+			print(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+			try:
+				fetch = fetch_submissions(free_slots)
+				backoff.succeeded()
 			except Exception as e:
-				print(f"Error: {e}")
-				error_log = f"An error occurred during evaluation:\n"
-				error_log += f"{type(e).__name__}\n"
-				error_log += f"Message: {e}\n"
-				error_log += f"Traceback: {traceback.format_exc()}\n"
-				error_log += f"Please create an issue with this error on GitLab: https://gitlab.fel.cvut.cz/b35apo/qtrvsim-eval-web/-/issues/new?issue[title]=Error%20in%20evaluator%20uid%20{s[4]}%20tid{s[1]}&issue[description]={type(e).__name__}%0A{urllib.parse.quote(str(traceback.format_exc()), safe='')}%0A{urllib.parse.quote(str(e), safe='')}"
+				fetch = None
+				backoff.failed("fetching submissions", e)
+
+			if fetch is not None:
+				submissions, task_filenames = fetch
+				for s in submissions:
+					#every job gets its own workspace, so that parallel workers do not collide
+					job = Job(s, task_filenames[s[1]], workspace.create(f"_job_{s[0]}_"))
+					in_flight[s[0]] = job
+					if needs_build_stage(job.task_filename):
+						build.put(job)
+					else:
+						simulate.put(job)
+
+		for stage in (build, simulate, commit):
+			stage.dispatch(wakeup_w)
+
+		#keep the leases of long running evaluations alive
+		if in_flight and time.monotonic() - last_renewal > db.LEASE_SECONDS / 3 and backoff.ready():
+			try:
+				db.renew_claims(list(in_flight.keys()))
+				last_renewal = time.monotonic()
+				backoff.succeeded()
+			except Exception as e:
+				backoff.failed("renewing claims", e)
 
-				db.update_submission(s[0])
-				db.update_result(s[4], s[1], -1, 99, error_log)
+		if metrics_enabled and metrics_backoff.ready():
+			try:
+				update_queue_metrics((build, simulate, commit))
+				metrics_backoff.succeeded()
+			except Exception as e:
+				metrics_backoff.failed("reading the queue metrics", e)
 
+		if listener is None and backoff.ready():
+			listener = open_listener()
 
-def evaluator_thread(num_submissions = 10, interval = 60):
-	"""Run the evaluator thread."""
-	while True:
-		print(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-		evaluate_submissions(num_submissions)
-		time.sleep(interval)
+		listener = wait_for_event(listener, wakeup_r, interval if backoff.ready() else min(interval, backoff.remaining()))
 
 if __name__ == "__main__":
-	num_submissions = 10	#number of submissions to evaluate at a time
-	interval = 10			#seconds between evaluations
-	while True:
-		#print current time
-		print(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-		evaluate_submissions(num_submissions)
-		time.sleep(interval)
\ No newline at end of file
+	interval = int(os.getenv('EVAL_POLL_INTERVAL') or 30)	#fallback polling interval in seconds
+	run_worker_pool(EVAL_WORKERS, interval)
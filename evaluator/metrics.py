@@ -0,0 +1,106 @@
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Port of the Prometheus metrics listener, metrics are not served when it is not set
+METRICS_PORT = int(os.getenv('EVAL_METRICS_PORT') or 0)
+
+# Address the listener binds to
+METRICS_ADDRESS = os.getenv('EVAL_METRICS_ADDRESS') or '0.0.0.0'
+
+# Upper bounds of the simulation time histogram buckets in seconds
+SIMULATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+	'webeval_evaluator_queue_depth': ('gauge', 'Submissions waiting for evaluation.', None),
+	'webeval_evaluator_oldest_pending_seconds': ('gauge', 'Age of the oldest submission waiting for evaluation.', None),
+	'webeval_evaluator_jobs': ('gauge', 'Jobs of this evaluator queued or running in a pipeline stage.', None),
+	'webeval_evaluator_submissions_total': ('counter', 'Evaluated submissions per result code.', None),
+	'webeval_evaluator_released_total': ('counter', 'Claimed submissions put back into the queue after a worker failure.', None),
+	'webeval_evaluator_testcase_simulation_seconds': ('histogram', 'Wall time of qtrvsim_cli per testcase.', SIMULATION_BUCKETS),
+	'webeval_evaluator_cache_lookups_total': ('counter', 'Lookups in the result and build caches.', None),
+	'webeval_evaluator_cache_hits_total': ('counter', 'Hits of the result and build caches.', None),
+}
+
+_lock = threading.Lock()
+_values = {} #(name, labels) -> value, histograms keep [count per bucket..., count above the last bucket, sum]
+
+def inc(name, labels=(), value=1):
+	'''Add <value> to the counter <name>, <labels> are (label, value) pairs.'''
+	with _lock:
+		_values[(name, labels)] = _values.get((name, labels), 0) + value
+
+def set_gauge(name, value, labels=()):
+	'''Set the gauge <name> to <value>.'''
+	with _lock:
+		_values[(name, labels)] = value
+
+def observe(name, value, labels=()):
+	'''Add <value> to the histogram <name>.'''
+	buckets = METRICS[name][2]
+	with _lock:
+		histogram = _values.get((name, labels))
+		if histogram is None:
+			histogram = _values[(name, labels)] = [0] * (len(buckets) + 1) + [0.0]
+		index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+		histogram[index] += 1
+		histogram[-1] += value
+
+def _format_labels(labels):
+	if not labels:
+		return ''
+	return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+def render():
+	'''Return all metrics in the Prometheus text format.'''
+	with _lock:
+		values = sorted((key, list(value) if isinstance(value, list) else value) for key, value in _values.items())
+
+	lines = []
+	for name, (kind, description, buckets) in METRICS.items():
+		lines.append(f'# HELP {name} {description}')
+		lines.append(f'# TYPE {name} {kind}')
+		for (metric, labels), value in values:
+			if metric != name:
+				continue
+
+			if kind != 'histogram':
+				lines.append(f'{name}{_format_labels(labels)} {value}')
+				continue
+
+			count = 0
+			for bound, bucket in zip(buckets + ('+Inf',), value):
+				count += bucket
+				lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {count}')
+			lines.append(f'{name}_sum{_format_labels(labels)} {value[-1]}')
+			lines.append(f'{name}_count{_format_labels(labels)} {count}')
+	return '\n'.join(lines) + '\n'
+
+class _Handler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path.split('?')[0] != '/metrics':
+			self.send_error(404)
+			return
+
+		body = render().encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		#scrapes every few seconds would flood the log
+		pass
+
+def start_server(port=METRICS_PORT, address=METRICS_ADDRESS):
+	'''Serve /metrics from a daemon thread, returns False when metrics are disabled.'''
+	if not port:
+		return False
+
+	server = ThreadingHTTPServer((address, port), _Handler)
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+	print(f"Serving metrics on {address}:{port}/metrics")
+	return True
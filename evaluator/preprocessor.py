@@ -3,9 +3,13 @@ import re
 import sys
 import random
 import ast
+import copy
 
 RE = r'\"\{\{\$\s*(\w+)\s*\$\}\}\"'
 
+# The same placeholder as a value of the parsed toml (without the quotes)
+PLACEHOLDER_RE = r'^\{\{\$\s*(\w+)\s*\$\}\}$'
+
 safe_globals = {
 	'__builtins__': {
 		'range': range,
@@ -37,25 +41,66 @@ def validate_and_compile(source):
 
 	return compile(tree, filename="<string>", mode="eval")
 
+def compile_preprocessor(preprocessor_code):
+	"""Validate and compile the expressions of a [preprocessor] section.
+
+	Returns a list of (variable name, code object), an exception is stored instead of
+	the code object when the expression is rejected.
+	"""
+	compiled = []
+	for var_name, code_str in preprocessor_code.items():
+		try:
+			compiled.append((var_name, validate_and_compile(code_str)))
+		except Exception as e:
+			compiled.append((var_name, e))
+	return compiled
+
+def evaluate_preprocessor(compiled, rng=None):
+	"""Evaluate compiled preprocessor expressions in order, returns the variables.
+
+	<rng> replaces the random module in the expressions (e.g. a seeded random.Random).
+	"""
+	eval_globals = safe_globals if rng is None else dict(safe_globals, random=rng)
+
+	context = {}
+	for var_name, compiled_code in compiled:
+		try:
+			if isinstance(compiled_code, Exception):
+				raise compiled_code
+
+			value = eval(compiled_code, eval_globals, context)
+			context[var_name] = value
+
+		except Exception as e:
+			print(f"Security/Runtime error in variable '{var_name}': {e}")
+			context[var_name] = f"ERROR_{var_name}"
+	return context
+
+def substitute_placeholders(data, context):
+	"""Return a copy of parsed toml <data>, where "{{$ var $}}" values are replaced by the variables from <context>."""
+	if isinstance(data, dict):
+		return {key: substitute_placeholders(value, context) for key, value in data.items()}
+
+	if isinstance(data, list):
+		return [substitute_placeholders(value, context) for value in data]
+
+	if isinstance(data, str):
+		match = re.match(PLACEHOLDER_RE, data)
+		if match:
+			var_name = match.group(1)
+			if var_name in context:
+				return copy.deepcopy(context[var_name])
+
+			print(f"Undefined variable '{var_name}' in placeholder")
+			return f"UNDEFINED_{var_name}"
+
+	return data
+
 def preprocess(f):
 	toml_content = f.read()
 	toml_dict = toml.loads(toml_content)
 
-	if 'preprocessor' in toml_dict:
-		preprocessor_code = toml_dict.pop('preprocessor')
-		context = {}
-		for var_name, code_str in preprocessor_code.items():
-			try:
-				compiled_code = validate_and_compile(code_str)
-				
-				value = eval(compiled_code, safe_globals, context)
-				context[var_name] = value
-				
-			except Exception as e:
-				print(f"Security/Runtime error in variable '{var_name}': {e}")
-				context[var_name] = f"ERROR_{var_name}"
-	else:
-		context = {}
+	context = evaluate_preprocessor(compile_preprocessor(toml_dict.get('preprocessor', {})))
 
 	def replace_placeholder(match):
 		var_name = match.group(1)
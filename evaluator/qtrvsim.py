@@ -4,15 +4,116 @@ import re
 from collections import defaultdict
 import os
 import json
+import time
+import shutil
+import signal
+import threading
+
+# Used to build the executable of tasks with assemble_once, same flags as the Makefiles of the tasks
+ASSEMBLE_MAKEFILE = """ARCH=riscv64-unknown-elf
+
+CC=$(ARCH)-gcc
+
+ARCHFLAGS = -mabi=ilp32 -march=rv32i -fno-lto
+AFLAGS = -ggdb $(ARCHFLAGS)
+LDFLAGS = -ggdb -nostartfiles -nostdlib -static $(ARCHFLAGS)
+
+submission : submission.o
+	$(CC) $(LDFLAGS) $^ -o $@
+
+submission.o : submission.S
+	$(CC) -D__ASSEMBLY__ $(AFLAGS) -c $< -o $@
+"""
+
+ASSEMBLER = "riscv64-unknown-elf-gcc"
+
+def run_measured(command, timeout, usage, kind, cwd=None, cancelled=None):
+	'''Run <command> like Popen.communicate() and record its resource usage.
+
+	The child is reaped by os.wait4(), which also returns the CPU time and the peak memory of
+	the child and of its waited-for descendants (e.g. the compilers started by make).
+
+	Args:
+		command (list): The command to run.
+		timeout (float): Seconds after which the command is killed.
+		usage (list): A dict with kind, wall, user and sys seconds and maxrss (kB) is appended to it.
+		kind (str): Kind of the run, e.g. "simulate" or "make".
+		cwd (str): Working directory of the command.
+		cancelled (threading.Event): The command is killed like on a timeout when it is set.
+
+	Returns:
+		tuple: (returncode, stdout, stderr), raises subprocess.TimeoutExpired after killing the command.
+	'''
+	started = time.monotonic()
+	process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+	output = {}
+	def read(name, stream):
+		output[name] = stream.read()
+		stream.close()
+
+	waited = []
+	def wait():
+		try:
+			waited.append(os.wait4(process.pid, 0))
+		except ChildProcessError:
+			pass
+
+	#daemon threads, descendants of a killed command may keep the pipes open
+	threads = [threading.Thread(target=read, args=(name, stream), daemon=True) for name, stream in (("stdout", process.stdout), ("stderr", process.stderr))]
+	waiter = threading.Thread(target=wait, daemon=True)
+	for thread in threads + [waiter]:
+		thread.start()
+
+	if cancelled is None:
+		waiter.join(timeout)
+	else:
+		deadline = started + timeout
+		while waiter.is_alive() and not cancelled.is_set() and time.monotonic() < deadline:
+			waiter.join(min(0.05, max(0, deadline - time.monotonic())))
+	killed = waiter.is_alive()
+	if killed:
+		#not process.kill(), its poll() could reap a child that just exited before the waiter does
+		try:
+			os.kill(process.pid, signal.SIGKILL)
+		except ProcessLookupError:
+			pass
+		waiter.join()
+
+	if waited:
+		_, status, rusage = waited[0]
+		#the child is already reaped, Popen must not wait for it again
+		process.returncode = os.waitstatus_to_exitcode(status)
+		user, system, maxrss = rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss
+	else:
+		#reaped by someone else, only the wall time is known
+		process.poll()
+		user, system, maxrss = 0.0, 0.0, 0
+
+	usage.append({
+		"kind": kind,
+		"wall": time.monotonic() - started,
+		"user": user,
+		"sys": system,
+		"maxrss": maxrss,
+	})
+
+	if killed:
+		raise subprocess.TimeoutExpired(command, timeout)
+
+	for thread in threads:
+		thread.join()
+	return (process.returncode, output["stdout"], output["stderr"])
 
 class QtRVSim:
-	def __init__(self, submission_file="", working_dir=""):
+	def __init__(self, submission_file="", working_dir="", file_prefix=""):
 		'''Create the QtRvSim evaluator object.
 
 		Args:
 			args (str): The arguments to pass to qtrvsim.
 			submission_file (str): The submission file to evaluate.
 			working_dir (str): The working directory to store the files.
+			file_prefix (str): Prefix of the memory, uart and output files, so that several testcases can run in one working directory.
 		'''
 
 		self.log = f"Evaluation started on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
@@ -51,7 +152,8 @@ class QtRVSim:
 		self.cache_stats = defaultdict(int)
 		self.scores = defaultdict(int)
 
-		self.timeout_time = 10 	#seconds
+		self.timeout_time = 10 	#seconds per simulation
+		self.make_timeout_time = 10 	#seconds per make run
 		self.cycle_limit = 0 	#cycles
 
 		self.cycle_limit_set = False
@@ -63,8 +165,9 @@ class QtRVSim:
 
 		self.verbose = False
 
-		self.mem_output_files_prefix = working_dir + "/"
-		self.starting_memory_files_prefix = working_dir + "/"
+		self.file_prefix = file_prefix
+		self.mem_output_files_prefix = working_dir + "/" + file_prefix
+		self.starting_memory_files_prefix = working_dir + "/" + file_prefix
 
 		self.mem_output_files = []
 		self.starting_memory_files = []
@@ -80,9 +183,14 @@ class QtRVSim:
 
 		self.makefile_present = False
 		self.makefile_successfull = True
+		self.makefile_timed_out = False
 		self.makefile_log = ""
 
 		self.error_log = ""
+
+		self.usage = [] # resource usage of every make and qtrvsim_cli run, see run_measured()
+		self.timings = [] # seconds spent simulating and parsing the output and the cycles of every testcase run
+		self.cancelled = None # threading.Event that stops the running simulation, see run_measured()
 	
 	def get_result(self) -> int:
 		'''Return the result of the evaluation.'''
@@ -155,7 +263,7 @@ class QtRVSim:
 			uart_file (str): The file to save the uart output to.'''
 		self.set_do_compare_uart(True) #compare uart
 		self.reference_uart = uart
-		self.uart_file = f"{self.working_dir}/{uart_file}"
+		self.uart_file = f"{self.mem_output_files_prefix}{uart_file}"
 		self.uart_arg += f" --serout {self.uart_file}"
 
 	def set_starting_memory(self, mem):
@@ -169,9 +277,9 @@ class QtRVSim:
 			curr_starting_memory_file = f"{self.starting_memory_files_prefix}{address}.in"
 			self.starting_memory_files.append(curr_starting_memory_file)
 
+			#one write per file, the arrays can be long
 			with open(curr_starting_memory_file, 'w') as file:
-				for val in mem[address]:
-					file.write(f"{val}\n")
+				file.write("".join(f"{val}\n" for val in mem[address]))
 
 			self.mem_arg += f" --load-range {address},{curr_starting_memory_file}"
 
@@ -214,7 +322,7 @@ class QtRVSim:
 	def read_uart_file(self):
 		'''Read the uart file and set the self.uart dictionary.'''
 		self.uart = ""
-		with open(f"{self.mem_output_files_prefix}__uart.out", 'r') as file:
+		with open(self.uart_file, 'r') as file:
 			self.uart = file.read()
 
 	def set_input_uart(self, uart, uart_file):
@@ -223,7 +331,7 @@ class QtRVSim:
 		Args:
 			uart (str): The uart input.
 			uart_file (str): The file to save the uart input to.'''
-		self.input_uart = f"{self.working_dir}/{uart_file}"
+		self.input_uart = f"{self.starting_memory_files_prefix}{uart_file}"
 		with open(f"{self.input_uart}", 'w') as file:
 			file.write(uart)
 		self.uart_arg += f" --serin {self.input_uart}"
@@ -253,11 +361,12 @@ class QtRVSim:
 			except:
 				pass
 
-	def end_eval(self, testcase):
+	def end_eval(self, testcase, clear_files=True):
 		'''End the evaluation and log the results.
 		
 		Args:
-			testcase (str): The name of the testcase.'''
+			testcase (str): The name of the testcase.
+			clear_files (bool): Remove the memory, uart and custom files, not needed when the whole working directory is removed.'''
 		self.log += f"\n\nEvaluation ended on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
 		
 		if self.results.get(testcase) is not None:
@@ -266,7 +375,8 @@ class QtRVSim:
 			score = 0
 
 		self.log += f"Result: {score}\n"
-		self.clear_files()
+		if clear_files:
+			self.clear_files()
 
 	def set_private(self):
 		'''Set the current evaluation to private.'''
@@ -283,6 +393,42 @@ class QtRVSim:
 
 		self.custom_files.append(f"{self.working_dir}/{file_name}")
 
+	def testcase_sim(self, index):
+		'''Return a new evaluator for one testcase.
+
+		It shares the configuration and the built files of this evaluator, but has its own
+		memory, uart and output files and its own log, so testcases can run in parallel.
+		Add its outcome back with merge_testcase().
+
+		Args:
+			index (int): Index of the testcase, used for the file names.'''
+		sim = QtRVSim(submission_file=self.submission_file, working_dir=self.working_dir, file_prefix=f"_test{index}_")
+		sim.log = ""
+		sim.args = self.args
+		sim.scoring_expr = list(self.scoring_expr)
+		sim.timeout_time = self.timeout_time
+		sim.make_timeout_time = self.make_timeout_time
+		sim.cycle_limit = self.cycle_limit
+		sim.cycle_limit_set = self.cycle_limit_set
+		sim.makefile_present = self.makefile_present
+		sim.verbose = self.verbose
+		return sim
+
+	def merge_testcase(self, sim):
+		'''Add the log and the results of a testcase evaluated by an evaluator from testcase_sim().'''
+		self.log += sim.log
+		self.results.update(sim.results)
+		self.result = sim.result
+		self.cycles = sim.cycles
+		self.merge_usage(sim)
+		if sim.error_log:
+			self.error_log = sim.error_log
+
+	def merge_usage(self, sim):
+		'''Add only the resource usage and the timings of a testcase evaluated by an evaluator from testcase_sim().'''
+		self.usage += sim.usage
+		self.timings += sim.timings
+
 	def reset(self):
 		'''Reset the evaluator.'''
 		self.do_compare_memory = False
@@ -431,26 +577,28 @@ class QtRVSim:
 		Args:
 			makefile (str): The makefile to create.'''
 		self.makefile_present = True
-		with open(self.mem_output_files_prefix + "Makefile", 'w') as f:
+		with open(os.path.join(self.working_dir, "Makefile"), 'w') as f:
 			f.write(makefile)
 
-	def run_make(self):
-		'''Run make in the working directory.'''
-		command = ["make"]
+	def run_make(self, targets=()):
+		'''Run make in the working directory.
+
+		Args:
+			targets (list): Targets to build, the default target if empty.'''
+		command = ["make"] + list(targets)
 		try:
-			process = subprocess.Popen(command, cwd=self.mem_output_files_prefix, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-			stdout, stderr = process.communicate(timeout=self.timeout_time)
+			return_code, stdout, stderr = run_measured(command, self.make_timeout_time, self.usage, "make", cwd=self.working_dir)
 		except subprocess.TimeoutExpired:
-			process.kill()
 			stdout, stderr = None, None
-			self.log += f"\nKilled after {self.timeout_time} seconds, while running make."
+			self.log += f"\nKilled after {self.make_timeout_time} seconds, while running make."
 			self.makefile_successfull = False
+			self.makefile_timed_out = True
 		else:
 			# Check the return code
-			if process.returncode == 0:
+			if return_code == 0:
 				self.makefile_successfull = True
 			else:
-				self.log += "\nMake command failed with return code: {}".format(process.returncode)
+				self.log += "\nMake command failed with return code: {}".format(return_code)
 				self.makefile_successfull = False
 
 		self.makefile_log = stderr.decode('utf-8') if stderr else ''
@@ -458,10 +606,40 @@ class QtRVSim:
 		#print(stdout.decode('utf-8') if stdout else '')
 		#print(stderr.decode('utf-8') if stderr else '')
 
+	def assemble(self):
+		'''Build the executable of an assembly submission once, so that qtrvsim_cli does not assemble it again for every testcase.
+
+		Falls back to the integrated assembler (--asm), which also reports the errors, when the toolchain
+		is not installed or the build fails.
+
+		Returns:
+			bool: True if the executable was built.
+		'''
+		if shutil.which(ASSEMBLER) is None:
+			return False
+
+		log = self.log
+		self.create_makefile(ASSEMBLE_MAKEFILE)
+		self.run_make()
+
+		if not self.makefile_successfull:
+			self.log = log
+			self.makefile_present = False
+			self.makefile_successfull = True
+			self.makefile_timed_out = False
+			self.makefile_log = ""
+			return False
+
+		return True
+
+	def get_executable_file(self):
+		'''Get the path of the executable built by make from the submission.'''
+		return self.submission_file.split(".")[0]
+
 	def run_make_clean(self):
 		'''Run make clean in the working directory.'''
 		command = ["make", "clean"]
-		process = subprocess.Popen(command, cwd=self.mem_output_files_prefix, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		process = subprocess.Popen(command, cwd=self.working_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 		stdout, stderr = process.communicate()
 		if self.verbose:
 			print(stdout.decode('utf-8'))
@@ -480,22 +658,21 @@ class QtRVSim:
 		#print(self.dump_mem_arg)
 		arguments = arguments.split()
 		
-		json_output_file = f"{self.working_dir}/qtrvsim_output.json"
+		json_output_file = f"{self.mem_output_files_prefix}qtrvsim_output.json"
 		command = ["qtrvsim_cli"] + arguments + ["--dump-to-json", json_output_file, "--asm", self.submission_file]
 		
 		if self.makefile_present:
-			command = ["qtrvsim_cli"] + arguments + ["--dump-to-json", json_output_file, self.submission_file.split(".")[0]]
+			command = ["qtrvsim_cli"] + arguments + ["--dump-to-json", json_output_file, self.get_executable_file()]
 
 		if self.verbose:
 			print("Running command: ", ' '.join(command), "\n\n\n")
 		
 		killed = False
 		assembly_error = False
+		simulate_started = time.monotonic()
 
 		try:
-			process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-			stdout, stderr = process.communicate(timeout=self.timeout_time)
-			return_code = process.returncode
+			return_code, stdout, stderr = run_measured(command, self.timeout_time, self.usage, "simulate", cancelled=self.cancelled)
 
 			if return_code != 0 or "error" in stderr.decode('utf-8') or "error" in stdout.decode('utf-8'):
 				self.error_log = stdout.decode('utf-8') + stderr.decode('utf-8')
@@ -503,11 +680,11 @@ class QtRVSim:
 				assembly_error = True
 
 		except subprocess.TimeoutExpired:
-			process.kill()
 			stdout, stderr = None, None
 			killed = True
 			self.log += f"\nKilled after {self.timeout_time} seconds."
 
+		parse_started = time.monotonic()
 		stdout_text =  "" if killed else stdout.decode('utf-8')
 		stderr_text = f'Killed after {self.timeout_time} seconds.' if killed else stderr.decode('utf-8')
 
@@ -551,6 +728,8 @@ class QtRVSim:
 						self.log += f"\nUART does not match, \nexpected:\n{self.reference_uart}\ngot:\n{self.uart}\n"
 						self.log += f"\nDifference:\n{differece}\n"
 
+		self.timings.append({"name": test_name, "simulate": parse_started - simulate_started, "parse": time.monotonic() - parse_started, "cycles": self.cycles})
+
 		if self.cycles >= self.cycle_limit and self.cycle_limit_set:
 			self.cycle_limit_exceeded = True
 			self.log += f"\nCycle limit exceeded, maximum is: {self.cycle_limit}\n"
@@ -0,0 +1,87 @@
+import os
+import hashlib
+import subprocess
+import evaldb as db
+
+# Set EVAL_RESULT_CACHE=0 to always evaluate
+ENABLED = os.getenv('EVAL_RESULT_CACHE', '1') != '0'
+
+# Timeouts depend on the load of the machine, internal errors on the evaluator and failed builds can be
+# caused by the environment (full /dev/shm, OOM killer, missing toolchain), never reuse them
+UNCACHED_RESULTS = (2, 4, 99)
+
+REUSED_NOTE = "\nThis result was reused from an earlier evaluation of identical code.\n"
+
+_simulator_version = None
+
+# Statistics of this process
+hits = 0
+lookups = 0
+saved_seconds = 0.0
+
+def simulator_version():
+	"""Return the output of qtrvsim_cli --version, None if it cannot be determined."""
+	global _simulator_version
+	if _simulator_version is None:
+		try:
+			process = subprocess.run(["qtrvsim_cli", "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=10)
+			_simulator_version = process.stdout.decode('utf-8').strip() if process.returncode == 0 else ''
+		except (OSError, subprocess.TimeoutExpired):
+			_simulator_version = ''
+	return _simulator_version or None
+
+def make_key(source, task):
+	"""Return the cache key of evaluating <source> against the taskcache.CachedTask <task>.
+
+	Returns None when the result must not be reused (the cache is disabled, the task generates
+	random data without a fixed preprocessor_seed or the simulator version is unknown).
+	"""
+	if not ENABLED:
+		return None
+
+	seed = task.result_cache_seed
+	if seed is None:
+		return None
+
+	version = simulator_version()
+	if version is None:
+		return None
+
+	return (hashlib.sha256(source.encode('utf-8')).hexdigest(), task.digest, version, seed)
+
+def lookup(key):
+	"""Return (score, result, log) of a cached evaluation, None on a miss."""
+	global hits, lookups, saved_seconds
+	if key is None:
+		return None
+
+	lookups += 1
+	try:
+		cached = db.get_cached_result(key)
+	except Exception as e:
+		print(f"  result cache lookup failed: {e}")
+		return None
+
+	if cached is None:
+		return None
+
+	score, result, result_file, eval_seconds = cached
+	hits += 1
+	saved_seconds += eval_seconds
+	return (score, result, (result_file or "") + REUSED_NOTE)
+
+def store(key, score, result, log, eval_seconds):
+	"""Remember the result of an evaluation that took <eval_seconds>."""
+	if key is None or result in UNCACHED_RESULTS:
+		return
+
+	#a failure here must not change the already stored result of the submission
+	try:
+		db.store_cached_result(key, score, result, log, eval_seconds)
+	except Exception as e:
+		print(f"  result cache store failed: {e}")
+
+def report():
+	"""Statistics of this process as a short text."""
+	rate = 100 * hits / lookups if lookups else 0
+	return f"result cache: {hits}/{lookups} hits ({rate:.0f} %), {saved_seconds:.1f} s saved"
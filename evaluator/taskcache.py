@@ -0,0 +1,98 @@
+import os
+import hashlib
+import random
+import toml
+from datetime import datetime, timezone
+from preprocessor import compile_preprocessor, evaluate_preprocessor, substitute_placeholders
+
+DEADLINE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Budget of a task calibrated from its reference solution (calibrate.py) is stored next to it, e.g. sum.budget.toml
+BUDGET_SUFFIX = '.budget.toml'
+
+def budget_path(path):
+	'''Path of the budget file of the task file <path>.'''
+	return os.path.splitext(path)[0] + BUDGET_SUFFIX
+
+def _budget_version(budget_stat):
+	return (budget_stat.st_mtime_ns, budget_stat.st_size) if budget_stat is not None else None
+
+class CachedTask:
+	def __init__(self, path, stat, content, budget_stat=None, budget_content=None):
+		'''Parsed task file with compiled preprocessor expressions.
+
+		Args:
+			path (str): Path to the task file.
+			stat (os.stat_result): Stat of the file at the time it was read.
+			content (str): Content of the task file.
+			budget_stat (os.stat_result): Stat of the budget file, None if the task has none.
+			budget_content (str): Content of the budget file.
+		'''
+		self.path = path
+		self.mtime_ns = stat.st_mtime_ns
+		self.size = stat.st_size
+		self.budget_version = _budget_version(budget_stat)
+		#a new budget can change the results, so it is a part of the digest
+		self.digest = hashlib.sha256((content + (budget_content or '')).encode('utf-8')).hexdigest()
+		self.budget = toml.loads(budget_content).get('budget', {}) if budget_content else {}
+
+		data = toml.loads(content)
+		self.preprocessor = compile_preprocessor(data.pop('preprocessor', {}))
+		self.preprocessor_seed = data.get('task', {}).get('preprocessor_seed', None)
+		self.data = data
+
+		submit_end = data.get('task', {}).get('submit_end', None)
+		self.submit_end = datetime.strptime(submit_end, DEADLINE_FORMAT).replace(tzinfo=timezone.utc) if submit_end else None
+
+	@property
+	def deterministic(self):
+		'''Check whether every evaluation gets the same task data.'''
+		return not self.preprocessor or self.preprocessor_seed is not None
+
+	@property
+	def result_cache_seed(self):
+		'''Seed part of the result cache key, None if the task generates different data for every evaluation.'''
+		if not self.deterministic:
+			return None
+		return str(self.preprocessor_seed) if self.preprocessor else ''
+
+	def is_current(self, stat, budget_stat=None):
+		'''Check whether the file and its budget were not changed since they were parsed.'''
+		return self.mtime_ns == stat.st_mtime_ns and self.size == stat.st_size and self.budget_version == _budget_version(budget_stat)
+
+	def instantiate(self):
+		'''Return task data for one evaluation.
+
+		The preprocessor variables are evaluated again (they are usually random, unless
+		the task sets preprocessor_seed), the returned data is a copy and can be modified by the caller.
+		'''
+		rng = None if self.preprocessor_seed is None else random.Random(self.preprocessor_seed)
+		context = evaluate_preprocessor(self.preprocessor, rng)
+		return substitute_placeholders(self.data, context)
+
+_cache = {} #path -> CachedTask
+
+def _read_budget(path):
+	'''Return (stat, content) of the budget file of <path>, (None, None) if there is none.'''
+	try:
+		with open(budget_path(path)) as f:
+			return (os.fstat(f.fileno()), f.read())
+	except FileNotFoundError:
+		return (None, None)
+
+def get_task(path):
+	'''Get the cached task, the files are parsed again only if they changed on disk.'''
+	stat = os.stat(path)
+	try:
+		budget_stat = os.stat(budget_path(path))
+	except FileNotFoundError:
+		budget_stat = None
+
+	task = _cache.get(path)
+	if task is None or not task.is_current(stat, budget_stat):
+		budget_stat, budget_content = _read_budget(path)
+		with open(path) as f:
+			task = CachedTask(path, stat, f.read(), budget_stat, budget_content)
+		_cache[path] = task
+
+	return task
@@ -0,0 +1,95 @@
+'''Tests of the evaluator that need neither the database nor QtRVSim, qtrvsim_cli is replaced by a script.
+
+Run them from this directory with: python3 -m unittest test_evaluator
+'''
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+import evaluator
+import workspace
+import resultcache
+import buildcache
+
+# Rejects every source like qtrvsim_cli does on an assembly error, no output files are written
+FAKE_QTRVSIM_CLI = '''#!/usr/bin/env python3
+import sys
+print(f"{sys.argv[-1]}:2:error:unknown instruction")
+sys.exit(1)
+'''
+
+# Two testcases comparing memory, the first one already fails to assemble
+TASK = '''[task]
+name = "Assembly error"
+
+[arguments]
+run = "--dump-cycles --cycle-limit 1000"
+
+[[testcases]]
+name = "first"
+[[testcases.starting_mem]]
+input = [3]
+[[testcases.reference_mem]]
+output = [2]
+
+[[testcases]]
+name = "second"
+[[testcases.starting_mem]]
+input = [4]
+[[testcases.reference_mem]]
+output = [3]
+'''
+
+SOURCE = '''main:
+	addx a0, a0, a0
+'''
+
+class AssemblyErrorTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.dir)
+
+		qtrvsim_cli = os.path.join(self.dir, 'qtrvsim_cli')
+		with open(qtrvsim_cli, 'w') as f:
+			f.write(FAKE_QTRVSIM_CLI)
+		os.chmod(qtrvsim_cli, os.stat(qtrvsim_cli).st_mode | stat.S_IEXEC)
+
+		self.task_filename = os.path.join(self.dir, 'asm_error.toml')
+		with open(self.task_filename, 'w') as f:
+			f.write(TASK)
+
+		path = os.environ['PATH']
+		os.environ['PATH'] = self.dir + os.pathsep + path
+		self.addCleanup(os.environ.__setitem__, 'PATH', path)
+
+		for module in (resultcache, buildcache):
+			enabled = module.ENABLED
+			module.ENABLED = False
+			self.addCleanup(setattr, module, 'ENABLED', enabled)
+
+	def evaluate(self):
+		job = evaluator.Job((1, 'asm_error', SOURCE, False, None), self.task_filename, workspace.create("_test_job_1_"))
+		try:
+			evaluator.simulate_stage(job)
+		finally:
+			workspace.remove(job.job_dir)
+		return job.outcome
+
+	def test_assembly_error_is_reported_with_line(self):
+		for workers in (1, 2):
+			with self.subTest(testcase_workers=workers):
+				testcase_workers = evaluator.EVAL_TESTCASE_WORKERS
+				evaluator.EVAL_TESTCASE_WORKERS = workers
+				try:
+					score, result, log = self.evaluate()
+				finally:
+					evaluator.EVAL_TESTCASE_WORKERS = testcase_workers
+
+				self.assertEqual(result, 5)
+				self.assertIn("Error in integrated assembly.", log)
+				self.assertIn("On line 2 in your code:", log)
+				self.assertIn("here -->addx a0, a0, a0", log)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,132 @@
+import os
+import shutil
+import tempfile
+
+# Directory name of the workspaces inside the selected root
+WORKSPACE_NAME = 'qtrvsim_web_eval'
+
+# RAM-backed filesystem used for the workspaces when it is available
+RAM_ROOT = '/dev/shm'
+
+# Root directory of the per-job workspaces, set EVAL_WORKSPACE_ROOT to override the automatic choice
+WORKSPACE_ROOT = os.getenv('EVAL_WORKSPACE_ROOT') or None
+
+# Prefix of the prepared task templates, they are kept next to the job directories
+TEMPLATE_PREFIX = '_task_'
+
+def candidate_roots():
+	"""Directories to create the workspaces in, in the order of preference."""
+	if WORKSPACE_ROOT is not None:
+		return [WORKSPACE_ROOT]
+
+	roots = []
+	if os.path.isdir(RAM_ROOT) and os.access(RAM_ROOT, os.W_OK | os.X_OK):
+		roots.append(os.path.join(RAM_ROOT, WORKSPACE_NAME))
+	roots.append(os.path.join(tempfile.gettempdir(), WORKSPACE_NAME))
+	return roots
+
+def create(prefix):
+	"""Create a new empty job directory and return its path.
+
+	The RAM-backed root is preferred, the next root is used when a directory cannot be created there."""
+	roots = candidate_roots()
+	for i, root in enumerate(roots):
+		try:
+			os.makedirs(root, exist_ok=True)
+			return tempfile.mkdtemp(prefix=prefix, dir=root)
+		except OSError:
+			if i == len(roots) - 1:
+				raise
+
+def remove(job_dir):
+	"""Remove the job directory with everything left in it."""
+	shutil.rmtree(job_dir, ignore_errors=True)
+
+def write_file(path, content):
+	"""Write <content> to <path> with a single write call."""
+	with open(path, 'w') as f:
+		f.write(content)
+
+def prepare_template(job_dir, group, version, files, build=None):
+	"""Get the template directory <version> of <group> next to <job_dir>, create it if it does not exist.
+
+	Args:
+		job_dir (str): Job directory the template is for, templates must be on the same filesystem to be linked.
+		group (str): Name of the templates of one task, the other versions of the group are removed.
+		version (str): Version of the template, e.g. digest of the task file.
+		files (dict): {file name: content} of the static files.
+		build (callable): Optional build(directory) that adds files built from the static ones, returns True on success.
+	"""
+	root = os.path.dirname(job_dir)
+	name = f"{TEMPLATE_PREFIX}{group}_"
+	path = os.path.join(root, name + version)
+	if os.path.isdir(path):
+		return path
+
+	#prepared in a scratch directory and renamed, so other workers never see a half-written template
+	scratch = tempfile.mkdtemp(prefix=f"_tmp{name}", dir=root)
+	try:
+		static_dir = os.path.join(scratch, 'static')
+		built_dir = os.path.join(scratch, 'built')
+		os.mkdir(static_dir)
+		os.mkdir(built_dir)
+
+		for file_name, content in files.items():
+			write_file(os.path.join(static_dir, file_name), content)
+
+		if build is not None:
+			build_dir = os.path.join(scratch, 'build')
+			shutil.copytree(static_dir, build_dir)
+			if build(build_dir):
+				for entry in os.listdir(build_dir):
+					if entry not in files:
+						shutil.move(os.path.join(build_dir, entry), built_dir)
+			shutil.rmtree(build_dir)
+
+		os.rename(scratch, path)
+	except OSError:
+		remove(scratch)
+		#another worker created it in the meantime
+		if not os.path.isdir(path):
+			raise
+		return path
+
+	for entry in os.listdir(root):
+		if entry.startswith(name) and entry != name + version:
+			remove(os.path.join(root, entry))
+
+	return path
+
+def populate(job_dir, template):
+	"""Fill <job_dir> from a template of prepare_template().
+
+	Static files are hardlinked, built files are copied (with their modification time, so make
+	does not build them again), because the tools may overwrite them in place. Nothing is left
+	in <job_dir> if it fails.
+	"""
+	created = []
+	try:
+		static_dir = os.path.join(template, 'static')
+		for entry in os.listdir(static_dir):
+			created.append(os.path.join(job_dir, entry))
+			try:
+				os.link(os.path.join(static_dir, entry), created[-1])
+			except OSError:
+				shutil.copy2(os.path.join(static_dir, entry), created[-1])
+
+		built_dir = os.path.join(template, 'built')
+		for entry in os.listdir(built_dir):
+			source = os.path.join(built_dir, entry)
+			created.append(os.path.join(job_dir, entry))
+			if os.path.isdir(source):
+				shutil.copytree(source, created[-1])
+			else:
+				shutil.copy2(source, created[-1])
+	except OSError:
+		#unlink what was linked, so that writing the files again cannot modify the template
+		for path in created:
+			if os.path.isdir(path) and not os.path.islink(path):
+				shutil.rmtree(path, ignore_errors=True)
+			elif os.path.lexists(path):
+				os.remove(path)
+		raise
@@ -0,0 +1,13 @@
+--
+-- Submission claims for running several evaluators against one queue.
+-- Apply to an existing database with:
+--   psql -h $DB_HOST -U $POSTGRES_USER -d $DB_DATABASE -f 001_submission_claims.sql
+--
+
+ALTER TABLE submissions ADD COLUMN IF NOT EXISTS claimed_by character varying(255);
+ALTER TABLE submissions ADD COLUMN IF NOT EXISTS claimed_at timestamp with time zone;
+
+CREATE INDEX IF NOT EXISTS idx_submissions_pending ON submissions(id) WHERE evaluated = false;
+
+COMMENT ON COLUMN submissions.claimed_by IS 'Evaluator instance currently evaluating the submission';
+COMMENT ON COLUMN submissions.claimed_at IS 'Start of the claim lease, expired leases are re-queued';
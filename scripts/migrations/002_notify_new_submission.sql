@@ -0,0 +1,23 @@
+--
+-- Wake up evaluators (LISTEN new_submission) as soon as a submission is inserted.
+-- Apply to an existing database with:
+--   psql -h $DB_HOST -U $POSTGRES_USER -d $DB_DATABASE -f 002_notify_new_submission.sql
+--
+
+--
+-- Trigger function to notify evaluators about new submissions
+--
+CREATE OR REPLACE FUNCTION notify_new_submission()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('new_submission', NEW.id::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_notify_new_submission ON submissions;
+
+CREATE TRIGGER trigger_notify_new_submission
+    AFTER INSERT ON submissions
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_new_submission();
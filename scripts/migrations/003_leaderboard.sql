@@ -0,0 +1,182 @@
+--
+-- Materialized scoreboard (leaderboard table maintained by triggers on results and users).
+-- Apply to an existing database with:
+--   psql -h $DB_HOST -U $POSTGRES_USER -d $DB_DATABASE -f 003_leaderboard.sql
+-- Users listed in config/filter are copied to users.scoreboard_hidden when the web app starts.
+--
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS scoreboard_hidden boolean NOT NULL DEFAULT false;
+
+--
+-- Table: leaderboard
+-- Materialized scoreboard ranking, one partition per (scope, scope_value, taskid).
+-- Maintained by the triggers below, read by the web scoreboards.
+--
+CREATE TABLE IF NOT EXISTS leaderboard (
+    scope character varying(16) NOT NULL,
+    scope_value character varying(255) NOT NULL DEFAULT '',
+    taskid integer NOT NULL,
+    userid uuid NOT NULL,
+    score_best integer NOT NULL,
+    rank integer NOT NULL,
+    points integer NOT NULL,
+    PRIMARY KEY (scope, scope_value, taskid, userid),
+    FOREIGN KEY (userid) REFERENCES users(id) ON DELETE CASCADE,
+    FOREIGN KEY (taskid) REFERENCES tasks(id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_leaderboard_userid ON leaderboard(userid);
+
+COMMENT ON COLUMN leaderboard.scope IS 'public, group or org';
+COMMENT ON COLUMN leaderboard.scope_value IS 'Group or organization name, empty for the public scoreboard';
+COMMENT ON COLUMN leaderboard.rank IS 'DENSE_RANK of score_best within the partition (lower score is better)';
+COMMENT ON COLUMN leaderboard.points IS '7 - rank for scores up to the fifth result, 0 for the rest';
+
+--
+-- Recompute one leaderboard partition
+--
+CREATE OR REPLACE FUNCTION refresh_leaderboard(p_scope varchar, p_scope_value varchar, p_taskid integer)
+RETURNS void AS $$
+BEGIN
+    -- Serialize concurrent refreshes of the same partition
+    PERFORM pg_advisory_xact_lock(hashtext('leaderboard:' || p_scope || ':' || p_scope_value || ':' || p_taskid));
+
+    DELETE FROM leaderboard WHERE scope = p_scope AND scope_value = p_scope_value AND taskid = p_taskid;
+
+    INSERT INTO leaderboard (scope, scope_value, taskid, userid, score_best, rank, points)
+    SELECT p_scope, p_scope_value, p_taskid, userid, score_best, score_rank,
+        CASE WHEN score_best <= MAX(score_best) FILTER (WHERE position <= 5) OVER () THEN 7 - score_rank ELSE 0 END
+    FROM (
+        SELECT results.userid, results.score_best,
+            DENSE_RANK() OVER (ORDER BY results.score_best ASC) AS score_rank,
+            ROW_NUMBER() OVER (ORDER BY results.score_best ASC) AS position
+        FROM results INNER JOIN users ON results.userid = users.id
+        WHERE results.taskid = p_taskid
+            AND results.score_best > 0
+            AND users.verified = true
+            AND users.scoreboard_hidden = false
+            AND CASE p_scope
+                WHEN 'public' THEN users.visibility = 0
+                WHEN 'group' THEN users."group" = p_scope_value AND users.visibility IN (2, 0)
+                WHEN 'org' THEN users.organization = p_scope_value AND users.visibility IN (1, 0)
+            END
+    ) ranked;
+END;
+$$ LANGUAGE plpgsql;
+
+--
+-- Recompute the partitions a user (with the given visibility, group and organization) can appear in.
+-- p_taskid NULL means all tasks.
+--
+CREATE OR REPLACE FUNCTION refresh_user_leaderboards(p_visibility integer, p_group varchar, p_organization varchar, p_taskid integer)
+RETURNS void AS $$
+DECLARE
+    task_id integer;
+BEGIN
+    FOR task_id IN SELECT id FROM tasks WHERE p_taskid IS NULL OR id = p_taskid LOOP
+        IF p_visibility = 0 THEN
+            PERFORM refresh_leaderboard('public', '', task_id);
+        END IF;
+        IF p_group IS NOT NULL AND p_visibility IN (2, 0) THEN
+            PERFORM refresh_leaderboard('group', p_group, task_id);
+        END IF;
+        IF p_organization IS NOT NULL AND p_visibility IN (1, 0) THEN
+            PERFORM refresh_leaderboard('org', p_organization, task_id);
+        END IF;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+--
+-- Rebuild the whole leaderboard
+--
+CREATE OR REPLACE FUNCTION rebuild_leaderboard()
+RETURNS void AS $$
+DECLARE
+    task_id integer;
+    scope_name varchar;
+BEGIN
+    DELETE FROM leaderboard;
+    FOR task_id IN SELECT id FROM tasks LOOP
+        PERFORM refresh_leaderboard('public', '', task_id);
+        FOR scope_name IN SELECT DISTINCT "group" FROM users WHERE "group" IS NOT NULL LOOP
+            PERFORM refresh_leaderboard('group', scope_name, task_id);
+        END LOOP;
+        FOR scope_name IN SELECT DISTINCT organization FROM users WHERE organization IS NOT NULL LOOP
+            PERFORM refresh_leaderboard('org', scope_name, task_id);
+        END LOOP;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+--
+-- Trigger function to update the leaderboard when a best score changes
+--
+CREATE OR REPLACE FUNCTION update_leaderboard_on_result()
+RETURNS TRIGGER AS $$
+DECLARE
+    result_row results%ROWTYPE;
+    result_user users%ROWTYPE;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        result_row := OLD;
+    ELSE
+        result_row := NEW;
+    END IF;
+
+    -- score_best is usually changed by update_best_score, not by the UPDATE itself,
+    -- so the trigger cannot be limited with UPDATE OF score_best
+    IF TG_OP = 'UPDATE' AND OLD.score_best IS NOT DISTINCT FROM NEW.score_best THEN
+        RETURN NULL;
+    END IF;
+
+    SELECT * INTO result_user FROM users WHERE id = result_row.userid;
+    IF NOT FOUND OR NOT result_user.verified OR result_user.scoreboard_hidden THEN
+        RETURN NULL;
+    END IF;
+
+    PERFORM refresh_user_leaderboards(result_user.visibility, result_user."group", result_user.organization, result_row.taskid);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_update_leaderboard_on_result ON results;
+
+CREATE TRIGGER trigger_update_leaderboard_on_result
+    AFTER INSERT OR UPDATE OR DELETE ON results
+    FOR EACH ROW
+    EXECUTE FUNCTION update_leaderboard_on_result();
+
+--
+-- Trigger function to update the leaderboard when a user moves between scoreboards
+--
+CREATE OR REPLACE FUNCTION update_leaderboard_on_user()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'UPDATE'
+        AND OLD.verified = NEW.verified
+        AND OLD.scoreboard_hidden = NEW.scoreboard_hidden
+        AND OLD.visibility = NEW.visibility
+        AND OLD."group" IS NOT DISTINCT FROM NEW."group"
+        AND OLD.organization IS NOT DISTINCT FROM NEW.organization THEN
+        RETURN NULL;
+    END IF;
+
+    PERFORM refresh_user_leaderboards(OLD.visibility, OLD."group", OLD.organization, NULL);
+    IF TG_OP = 'UPDATE' THEN
+        PERFORM refresh_user_leaderboards(NEW.visibility, NEW."group", NEW.organization, NULL);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_update_leaderboard_on_user ON users;
+
+CREATE TRIGGER trigger_update_leaderboard_on_user
+    AFTER UPDATE OR DELETE ON users
+    FOR EACH ROW
+    EXECUTE FUNCTION update_leaderboard_on_user();
+
+ALTER TABLE leaderboard OWNER TO qtrvsim;
+
+SELECT rebuild_leaderboard();
@@ -0,0 +1,140 @@
+--
+-- Version counter of the scoreboard data, used by the web scoreboard cache.
+-- Requires 003_leaderboard.sql. Apply to an existing database with:
+--   psql -h $DB_HOST -U $POSTGRES_USER -d $DB_DATABASE -f 004_scoreboard_version.sql
+--
+
+CREATE TABLE IF NOT EXISTS scoreboard_version (
+    id integer NOT NULL DEFAULT 1 CHECK (id = 1),
+    version bigint NOT NULL DEFAULT 0,
+    updated_at timestamp with time zone NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id)
+);
+
+INSERT INTO scoreboard_version DEFAULT VALUES ON CONFLICT (id) DO NOTHING;
+
+ALTER TABLE scoreboard_version OWNER TO qtrvsim;
+
+CREATE OR REPLACE FUNCTION bump_scoreboard_version()
+RETURNS void AS $$
+BEGIN
+    UPDATE scoreboard_version SET version = version + 1, updated_at = NOW();
+END;
+$$ LANGUAGE plpgsql;
+
+--
+-- The version row is updated once per transaction when it commits (deferred triggers below).
+-- Updating it right away would keep the row locked while the transaction goes on locking
+-- leaderboard partitions, two concurrent result commits could deadlock on that.
+--
+CREATE OR REPLACE FUNCTION mark_scoreboard_changed()
+RETURNS void AS $$
+BEGIN
+    PERFORM set_config('webeval.scoreboard_changed', 'on', true);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bump_scoreboard_version_at_commit()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF current_setting('webeval.scoreboard_changed', true) = 'on' THEN
+        PERFORM set_config('webeval.scoreboard_changed', 'off', true);
+        PERFORM bump_scoreboard_version();
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION refresh_leaderboard(p_scope varchar, p_scope_value varchar, p_taskid integer)
+RETURNS void AS $$
+BEGIN
+    -- Serialize concurrent refreshes of the same partition
+    PERFORM pg_advisory_xact_lock(hashtext('leaderboard:' || p_scope || ':' || p_scope_value || ':' || p_taskid));
+
+    DELETE FROM leaderboard WHERE scope = p_scope AND scope_value = p_scope_value AND taskid = p_taskid;
+
+    INSERT INTO leaderboard (scope, scope_value, taskid, userid, score_best, rank, points)
+    SELECT p_scope, p_scope_value, p_taskid, userid, score_best, score_rank,
+        CASE WHEN score_best <= MAX(score_best) FILTER (WHERE position <= 5) OVER () THEN 7 - score_rank ELSE 0 END
+    FROM (
+        SELECT results.userid, results.score_best,
+            DENSE_RANK() OVER (ORDER BY results.score_best ASC) AS score_rank,
+            ROW_NUMBER() OVER (ORDER BY results.score_best ASC) AS position
+        FROM results INNER JOIN users ON results.userid = users.id
+        WHERE results.taskid = p_taskid
+            AND results.score_best > 0
+            AND users.verified = true
+            AND users.scoreboard_hidden = false
+            AND CASE p_scope
+                WHEN 'public' THEN users.visibility = 0
+                WHEN 'group' THEN users."group" = p_scope_value AND users.visibility IN (2, 0)
+                WHEN 'org' THEN users.organization = p_scope_value AND users.visibility IN (1, 0)
+            END
+    ) ranked;
+
+    PERFORM mark_scoreboard_changed();
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION update_leaderboard_on_user()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'UPDATE'
+        AND OLD.verified = NEW.verified
+        AND OLD.scoreboard_hidden = NEW.scoreboard_hidden
+        AND OLD.visibility = NEW.visibility
+        AND OLD."group" IS NOT DISTINCT FROM NEW."group"
+        AND OLD.organization IS NOT DISTINCT FROM NEW.organization THEN
+        -- Names are not part of the leaderboard, but they are shown on the scoreboards
+        IF OLD.username <> NEW.username OR OLD.display_name IS DISTINCT FROM NEW.display_name THEN
+            PERFORM mark_scoreboard_changed();
+        END IF;
+        RETURN NULL;
+    END IF;
+
+    PERFORM refresh_user_leaderboards(OLD.visibility, OLD."group", OLD.organization, NULL);
+    IF TG_OP = 'UPDATE' THEN
+        PERFORM refresh_user_leaderboards(NEW.visibility, NEW."group", NEW.organization, NULL);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bump_scoreboard_version_on_tasks()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM mark_scoreboard_changed();
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_bump_scoreboard_version_on_tasks ON tasks;
+
+CREATE TRIGGER trigger_bump_scoreboard_version_on_tasks
+    AFTER INSERT OR UPDATE OR DELETE ON tasks
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION bump_scoreboard_version_on_tasks();
+
+DROP TRIGGER IF EXISTS trigger_bump_scoreboard_version_at_commit ON results;
+
+CREATE CONSTRAINT TRIGGER trigger_bump_scoreboard_version_at_commit
+    AFTER INSERT OR UPDATE OR DELETE ON results
+    DEFERRABLE INITIALLY DEFERRED
+    FOR EACH ROW
+    EXECUTE FUNCTION bump_scoreboard_version_at_commit();
+
+DROP TRIGGER IF EXISTS trigger_bump_scoreboard_version_at_commit ON users;
+
+CREATE CONSTRAINT TRIGGER trigger_bump_scoreboard_version_at_commit
+    AFTER INSERT OR UPDATE OR DELETE ON users
+    DEFERRABLE INITIALLY DEFERRED
+    FOR EACH ROW
+    EXECUTE FUNCTION bump_scoreboard_version_at_commit();
+
+DROP TRIGGER IF EXISTS trigger_bump_scoreboard_version_at_commit ON tasks;
+
+CREATE CONSTRAINT TRIGGER trigger_bump_scoreboard_version_at_commit
+    AFTER INSERT OR UPDATE OR DELETE ON tasks
+    DEFERRABLE INITIALLY DEFERRED
+    FOR EACH ROW
+    EXECUTE FUNCTION bump_scoreboard_version_at_commit();
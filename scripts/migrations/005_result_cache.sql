@@ -0,0 +1,28 @@
+--
+-- Result cache of the evaluator (reuse results of identical code and task).
+-- Apply to an existing database with:
+--   psql -h $DB_HOST -U $POSTGRES_USER -d $DB_DATABASE -f 005_result_cache.sql
+--
+
+CREATE TABLE IF NOT EXISTS result_cache (
+    source_hash character(64) NOT NULL,
+    task_digest character(64) NOT NULL,
+    simulator_version character varying(255) NOT NULL,
+    preprocessor_seed character varying(64) NOT NULL DEFAULT '',
+    score integer NOT NULL,
+    result integer NOT NULL,
+    result_file text,
+    eval_seconds double precision NOT NULL,
+    hits integer NOT NULL DEFAULT 0,
+    created_at timestamp with time zone NOT NULL DEFAULT NOW(),
+    last_hit_at timestamp with time zone,
+    PRIMARY KEY (source_hash, task_digest, simulator_version, preprocessor_seed)
+);
+
+COMMENT ON COLUMN result_cache.source_hash IS 'sha256 of the submitted code';
+COMMENT ON COLUMN result_cache.task_digest IS 'sha256 of the task file';
+COMMENT ON COLUMN result_cache.simulator_version IS 'Output of qtrvsim_cli --version';
+COMMENT ON COLUMN result_cache.preprocessor_seed IS 'preprocessor_seed of the task, empty for tasks without a preprocessor';
+COMMENT ON COLUMN result_cache.eval_seconds IS 'Duration of the original evaluation, saved again by every hit';
+
+ALTER TABLE result_cache OWNER TO qtrvsim;
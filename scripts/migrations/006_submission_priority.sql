@@ -0,0 +1,9 @@
+--
+-- Low priority lane for re-evaluations requested by an admin.
+-- Apply to an existing database with:
+--   psql -h $DB_HOST -U $POSTGRES_USER -d $DB_DATABASE -f 006_submission_priority.sql
+--
+
+ALTER TABLE submissions ADD COLUMN IF NOT EXISTS low_priority boolean NOT NULL DEFAULT false;
+
+COMMENT ON COLUMN submissions.low_priority IS 'Re-evaluation requested by an admin, evaluated after all other submissions';
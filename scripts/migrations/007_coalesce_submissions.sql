@@ -0,0 +1,9 @@
+--
+-- Pending submissions superseded by a newer one of the same user can be skipped.
+-- Apply to an existing database with:
+--   psql -h $DB_HOST -U $POSTGRES_USER -d $DB_DATABASE -f 007_coalesce_submissions.sql
+--
+
+ALTER TABLE submissions ADD COLUMN IF NOT EXISTS skipped boolean NOT NULL DEFAULT false;
+
+COMMENT ON COLUMN submissions.skipped IS 'Not evaluated, superseded by a newer submission of the same user (task option coalesce)';
@@ -0,0 +1,10 @@
+--
+-- Results remember the submission that produced them, so results committed out of order
+-- do not overwrite the result of a newer submission.
+-- Apply to an existing database with:
+--   psql -h $DB_HOST -U $POSTGRES_USER -d $DB_DATABASE -f 008_result_submission_id.sql
+--
+
+ALTER TABLE results ADD COLUMN IF NOT EXISTS submission_id integer;
+
+COMMENT ON COLUMN results.submission_id IS 'Submission that produced score_last, result and result_file, results of older submissions do not overwrite them';
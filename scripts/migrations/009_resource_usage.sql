@@ -0,0 +1,32 @@
+--
+-- Resource usage of the evaluation runs, shown per task on the admin statistics page.
+-- Apply to an existing database with:
+--   psql -h $DB_HOST -U $POSTGRES_USER -d $DB_DATABASE -f 009_resource_usage.sql
+--
+
+--
+-- Table: resource_usage
+-- Resources used by the make and qtrvsim_cli runs of an evaluated submission, one row per kind of run.
+--
+CREATE TABLE IF NOT EXISTS resource_usage (
+    submission_id integer NOT NULL,
+    taskid integer NOT NULL,
+    kind character varying(16) NOT NULL,
+    runs integer NOT NULL,
+    wall_seconds double precision NOT NULL,
+    user_seconds double precision NOT NULL,
+    sys_seconds double precision NOT NULL,
+    max_rss_kb bigint NOT NULL,
+    created_at timestamp with time zone NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (submission_id, kind),
+    FOREIGN KEY (submission_id) REFERENCES submissions(id) ON DELETE CASCADE,
+    FOREIGN KEY (taskid) REFERENCES tasks(id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_resource_usage_taskid ON resource_usage(taskid);
+
+COMMENT ON COLUMN resource_usage.kind IS 'make or simulate';
+COMMENT ON COLUMN resource_usage.runs IS 'Number of runs, the times are their sums';
+COMMENT ON COLUMN resource_usage.max_rss_kb IS 'Peak resident memory of the largest run';
+
+ALTER TABLE resource_usage OWNER TO qtrvsim;
@@ -3,6 +3,7 @@
 from flask import Blueprint, render_template, request, redirect, session
 from auth import admin_required
 import db, os, re, csv, io
+import task_registry
 
 TASKS_DIR = None
 TEMPLATES_DIR = None
@@ -53,6 +54,7 @@ def filter_user(user_id):
 		if not os.path.exists(filter_file):
 			with open(filter_file, 'w') as f:
 				f.write('')
+		db.set_scoreboard_hidden(user_id, True)
 	return redirect('/admin/users')
 
 
@@ -66,6 +68,7 @@ def unfilter_user(user_id):
 		filter_file = os.path.join('config/filter', username)
 		if os.path.exists(filter_file):
 			os.remove(filter_file)
+		db.set_scoreboard_hidden(user_id, False)
 	return redirect('/admin/users')
 
 
@@ -468,6 +471,7 @@ def save_task_file(task_id):
 	try:
 		with open(filepath, 'w') as f:
 			f.write(content)
+		task_registry.invalidate(filepath)
 		return json.dumps({'success': True, 'message': 'File saved successfully'})
 	except Exception as e:
 		return json.dumps({'error': str(e)}), 500
@@ -527,6 +531,7 @@ def save_template_file(filename):
 	try:
 		with open(filepath, 'w') as f:
 			f.write(content)
+		task_registry.invalidate(filepath)
 		return json.dumps({'success': True, 'message': 'File saved successfully'})
 	except Exception as e:
 		return json.dumps({'error': str(e)}), 500
@@ -590,6 +595,14 @@ def admin_statistics():
 	unique_tasks = set(stat[4] for stat in stats)  # stat[4] is task_name
 	total_users = len(unique_users)
 	total_tasks = len(unique_tasks)
+
+	cache_entries, cache_hits, cache_saved_seconds = db.get_result_cache_statistics()
+	result_cache = {
+		'hits': cache_hits,
+		'evaluations': cache_entries + cache_hits,
+		'hit_rate': 100 * cache_hits / (cache_entries + cache_hits) if cache_entries + cache_hits else 0,
+		'saved_seconds': cache_saved_seconds
+	}
 	
 	return render_template('admin_statistics.html', 
 		sessions=session, 
@@ -597,6 +610,8 @@ def admin_statistics():
 		total_submissions=total_submissions,
 		total_users=total_users,
 		total_tasks=total_tasks,
+		result_cache=result_cache,
+		resource_usage=db.get_resource_usage_statistics(),
 		username_filter=username_filter,
 		organization_filter=organization_filter,
 		group_filter=group_filter,
@@ -3,7 +3,7 @@ from datetime import datetime
 from auth import api_key_required, user_api_key_required
 import db
 import os
-import toml
+import task_registry
 
 TASKS_DIR = None
 URL = None
@@ -62,8 +62,7 @@ def api_submit():
 		if task_path:
 			task_path = os.path.join(TASKS_DIR, os.path.basename(task_path[0]))
 			if os.path.exists(task_path):
-				with open(task_path) as f:
-					task_data = toml.load(f)
+				task_data = task_registry.get_task_data(task_path)
 				
 				# Check deadlines
 				deadlines = task_data.get('task', {})
@@ -161,8 +160,7 @@ def user_get_task(user_id, username, task_id):
 		if not os.path.exists(task_path):
 			return {'error': 'Task file not found'}, 404
 		
-		with open(task_path) as f:
-			task_data = toml.load(f)
+		task_data = task_registry.get_task_data(task_path)
 		
 		task_info = task_data.get('task', {})
 		
@@ -172,9 +170,7 @@ def user_get_task(user_id, username, task_id):
 		if template_path:
 			if not os.path.isabs(template_path):
 				template_path = os.path.join(os.path.dirname(TASKS_DIR), 'S_templates', os.path.basename(template_path))
-			if os.path.exists(template_path):
-				with open(template_path) as f:
-					template_code = f.read()
+			template_code = task_registry.get_template(template_path)
 		
 		# Get user's submissions and scores
 		# Query for last_source, best_source, score_last, score_best from results table
@@ -261,8 +257,7 @@ def user_submit(user_id, username):
 		if task_path:
 			task_path = os.path.join(TASKS_DIR, os.path.basename(task_path[0]))
 			if os.path.exists(task_path):
-				with open(task_path) as f:
-					task_data = toml.load(f)
+				task_data = task_registry.get_task_data(task_path)
 				
 				# Check deadlines
 				deadlines = task_data.get('task', {})
@@ -1,13 +1,16 @@
-from flask import Flask, render_template, session
+from flask import Flask, render_template, session, request, g
 from flask_mail import Mail
 from markdown import markdown
 from dotenv import load_dotenv
 import os
 import sys
+import time
 import logging
-import toml
 import db
+import metrics
+import task_registry
 from util import check_submission_deadlines
+from auth import api_key_required
 import admin as admin_module
 import login as login_module
 import tasks as tasks_module
@@ -54,8 +57,46 @@ def get_filtered_users():
 		return []
 	return [f for f in os.listdir(FILTER_DIR) if os.path.isfile(os.path.join(FILTER_DIR, f))]
 
+# mtime of FILTER_DIR at the last sync of the filtered users, None until the first one
+_filter_mtime = None
+
 mail = Mail(app)
 
+# Every request borrows one pooled database connection, return it when the request ends
+app.teardown_appcontext(db.close_request_connection)
+
+@app.before_request
+def start_request_timer():
+	g._request_started = time.monotonic()
+
+@app.before_request
+def sync_filtered_users():
+	"""Copy config/filter into users.scoreboard_hidden, which the scoreboards read.
+
+	config/filter stays the source of truth, files added or removed outside of the admin pages
+	change the mtime of the directory and are synced by the next request of every worker."""
+	global _filter_mtime
+	try:
+		mtime = os.stat(FILTER_DIR).st_mtime_ns
+	except OSError:
+		mtime = 0
+	if mtime == _filter_mtime:
+		return
+
+	try:
+		db.sync_scoreboard_hidden(get_filtered_users())
+		_filter_mtime = mtime
+	except Exception as e:
+		app.logger.error(f"Failed to sync filtered users to the database: {e}")
+
+@app.teardown_request
+def observe_request(exception=None):
+	"""Measure the latency of the request per blueprint (metrics)."""
+	started = g.pop('_request_started', None)
+	if started is not None:
+		metrics.observe('webeval_http_request_duration_seconds', time.monotonic() - started, (('blueprint', request.blueprint or 'app'),))
+		metrics.flush()
+
 def check_admin() -> bool:
 	if 'logged_in' not in session:
 		return False
@@ -84,7 +125,7 @@ app.register_blueprint(sso_module.sso_bp, url_prefix='/sso')
 tasks_module.init_tasks(TASKS_DIR, TEMPLATES_DIR, check_submission_deadlines, check_admin)
 app.register_blueprint(tasks_module.tasks_bp)
 
-scoreboard_module.init_scoreboard(get_filtered_users, check_admin)
+scoreboard_module.init_scoreboard(check_admin)
 app.register_blueprint(scoreboard_module.scoreboard_bp)
 
 app.register_blueprint(profile_module.profile_bp)
@@ -100,62 +141,43 @@ def index():
 	is_admin = check_admin()
 	userid = session.get('user_id') if 'logged_in' in session else None
 	
-	if is_admin:
-		task = db.list_all_tasks()
-	else:
-		task = db.list_tasks()
+	user_results = db.get_user_task_results(userid) if userid else {}
+	now = datetime.now(timezone.utc).replace(tzinfo=None)
 
 	tasks = []
-	if task:
-		for t in task:
-			if is_admin:
-				task_id, task_name, available = t
-			else:
-				task_id, task_name = t
-				available = True
-			
-			task_path = db.get_task_path(task_id)
-			deadline_info = None
-			
-			if task_path:
-				task_file = os.path.join(TASKS_DIR, os.path.basename(task_path[0]))
-				if os.path.exists(task_file):
-					try:
-						with open(task_file) as f:
-							task_data = toml.load(f)
-						
-						submit_start = task_data['task'].get('submit_start', None)
-						submit_end = task_data['task'].get('submit_end', None)
-						
-						now = datetime.now(timezone.utc).replace(tzinfo=None)
-						
-						if submit_start:
-							start_time = datetime.strptime(submit_start, '%Y-%m-%dT%H:%M:%SZ')
-							if now < start_time:
-								delta = start_time - now
-								deadline_info = ('opens', delta)
-						
-						if submit_end and not deadline_info:
-							end_time = datetime.strptime(submit_end, '%Y-%m-%dT%H:%M:%SZ')
-							if now < end_time:
-								delta = end_time - now
-								deadline_info = ('closes', delta)
-					except Exception as e:
-						pass
-			
-			task_status = None
-			if userid:
-				result = db.get_user_task_result(userid, task_id)
-				if result is not None:
-					result_code = result[0]
-					if result_code == 0:
-						task_status = 'success'
-					elif result_code > 0:
-						task_status = 'error'
-					elif result_code < 0:
-						task_status = 'waiting'
-			
-			tasks.append((task_id, task_name, deadline_info, task_status, available))
+	for task_id, task_name, task_path, available in db.list_tasks_with_filepath():
+		if not available and not is_admin:
+			continue
+
+		deadline_info = None
+		if task_path:
+			task_file = os.path.join(TASKS_DIR, os.path.basename(task_path))
+			try:
+				deadlines = task_registry.get_deadlines(task_file)
+			except Exception as e:
+				app.logger.warning(f"Failed to read the deadlines of {task_file}: {e}")
+				deadlines = None
+
+			if deadlines:
+				start_time = deadlines['submit_start']
+				end_time = deadlines['submit_end']
+
+				if start_time and now < start_time:
+					deadline_info = ('opens', start_time - now)
+				elif end_time and now < end_time:
+					deadline_info = ('closes', end_time - now)
+
+		task_status = None
+		result_code = user_results.get(task_id)
+		if result_code is not None:
+			if result_code == 0:
+				task_status = 'success'
+			elif result_code > 0:
+				task_status = 'error'
+			elif result_code < 0:
+				task_status = 'waiting'
+
+		tasks.append((task_id, task_name, deadline_info, task_status, available))
 
 	return render_template('index.html', sessions=session, tasks=tasks, is_admin=is_admin)
 
@@ -170,6 +192,14 @@ def about():
 
 	return render_template('about.html', sessions=session, description=description)
 
+@app.route('/metrics')
+@api_key_required
+def metrics_endpoint():
+	"""Prometheus metrics of all workers of the web server."""
+	depth, oldest = db.get_queue_depth()
+	gauges = {'webeval_queue_depth': depth, 'webeval_oldest_pending_seconds': oldest}
+	return metrics.render(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 @app.errorhandler(400)
 def page_bad_request(e):
 	return render_template('400.html'), 400
@@ -1,7 +1,13 @@
 import psycopg2
+from psycopg2 import pool as pg_pool
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from flask import g, has_app_context
 from dotenv import load_dotenv
 import os
+import sys
+import time
 import json
+import metrics
 
 # Load .env from /app/.env in Docker or ../.env locally
 env_path = "/app/.env" if os.path.exists("/app/.env") else "../.env"
@@ -17,9 +23,117 @@ db_config = {
 	'connect_timeout': 10
 }
 
+# Connections kept open between requests and maximum number of open connections per gunicorn worker
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN') or 1)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE') or 5)
+
+_pool = None
+_pool_pid = None
+
+# Pools inherited from the parent process over fork(), they must never be closed here
+_inherited_pools = []
+
+def get_pool():
+	"""Get the connection pool of this worker process, it is created lazily after fork."""
+	global _pool, _pool_pid
+	if _pool_pid != os.getpid():
+		if _pool is not None:
+			_inherited_pools.append(_pool)
+		_pool = pg_pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_SIZE, **db_config)
+		_pool_pid = os.getpid()
+	return _pool
+
+def _reset(conn):
+	"""Roll back whatever the previous user left uncommitted, like closing the connection would."""
+	if conn.closed:
+		return
+	try:
+		if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+			conn.rollback()
+	except psycopg2.Error:
+		pass
+
+def _is_alive(conn):
+	"""Check that the server still serves the idle connection <conn> (it may have been restarted or timed it out)."""
+	if conn.closed:
+		return False
+	try:
+		cursor = conn.cursor()
+		cursor.execute('SELECT 1')
+		cursor.close()
+		conn.rollback()
+		return True
+	except (psycopg2.OperationalError, psycopg2.InterfaceError):
+		return False
+
+def _checkout():
+	"""Borrow a working connection from the pool, dead idle connections are discarded."""
+	#after a server restart all idle connections are dead, the last attempt opens a new one
+	for attempt in range(DB_POOL_SIZE):
+		conn = get_pool().getconn()
+		if _is_alive(conn):
+			return conn
+		get_pool().putconn(conn, close=True)
+	return get_pool().getconn()
+
+def _checkin(conn):
+	"""Return a connection to the pool, broken connections are discarded."""
+	_reset(conn)
+	get_pool().putconn(conn, close=bool(conn.closed))
+
+class PooledConnection:
+	"""A pooled connection, close() hands it back instead of closing it.
+
+	Inside of a Flask request the same connection is reused by all db calls and it is
+	returned to the pool at the end of the request (close_request_connection).
+	"""
+
+	def __init__(self, conn, request_scoped, caller=None):
+		self._conn = conn
+		self._request_scoped = request_scoped
+		self._caller = caller
+		self._opened = time.monotonic()
+
+	def __getattr__(self, name):
+		return getattr(self._conn, name)
+
+	def close(self):
+		if self._conn is None:
+			return
+
+		conn, self._conn = self._conn, None
+		if self._caller is not None:
+			metrics.observe('webeval_db_call_duration_seconds', time.monotonic() - self._opened, (('function', self._caller),))
+		if self._request_scoped:
+			_reset(conn)
+		else:
+			_checkin(conn)
+
+def close_request_connection(exception=None):
+	"""Return the connection of the current request to the pool (teardown handler)."""
+	conn = g.pop('_db_connection', None)
+	if conn is not None:
+		_checkin(conn)
+
 def connect():
-	"""Connect to the database."""
-	db = psycopg2.connect(**db_config)
+	"""Connect to the database.
+
+	The time until the connection is closed is measured per calling function (metrics)."""
+	caller = sys._getframe(1).f_code.co_name
+	if has_app_context():
+		conn = g.get('_db_connection')
+		if conn is not None and conn.closed:
+			close_request_connection()
+			conn = None
+		if conn is None:
+			conn = _checkout()
+			g._db_connection = conn
+		else:
+			_reset(conn)
+		db = PooledConnection(conn, request_scoped=True, caller=caller)
+	else:
+		db = PooledConnection(_checkout(), request_scoped=False, caller=caller)
+
 	cursor = db.cursor()
 	return (db, cursor)
 
@@ -50,6 +164,15 @@ def get_user_task_result(userid, taskid):
 	db.close()
 	return result
 
+def get_user_task_results(userid):
+	"""Get user's results for all tasks as a dict {taskid: result}."""
+	(db, cursor) = connect()
+	cursor.execute('SELECT taskid, result FROM results WHERE userid = %s', (userid,))
+	results = dict(cursor.fetchall())
+	cursor.close()
+	db.close()
+	return results
+
 def list_tasks_with_filepath():
 	"""List all tasks with their file path."""
 	(db, cursor) = connect()
@@ -318,6 +441,38 @@ def get_best_only_scores_for_org(taskid, org, is_admin=False):
 	db.close()
 	return scores
 
+def get_scoreboard(scope='public', value=None):
+	"""Get the ranked best scores of all active tasks from the leaderboard table.
+
+	<scope> is 'public', 'group' or 'org', <value> is the group or organization name.
+	The leaderboard is maintained by database triggers, see docker/webeval_schema.sql.
+	Tasks without any result are returned once with NULL user columns.
+
+	Returns rows (task_name, username, score_best, userid, points, display_name) ordered by task sequence and points.
+	"""
+	(db, cursor) = connect()
+	cursor.execute('''
+		SELECT tasks.name, users.username, leaderboard.score_best, leaderboard.userid, leaderboard.points, users.display_name
+		FROM tasks
+		LEFT JOIN leaderboard ON leaderboard.taskid = tasks.id AND leaderboard.scope = %s AND leaderboard.scope_value = %s
+		LEFT JOIN users ON leaderboard.userid = users.id
+		WHERE tasks.available = true
+		ORDER BY tasks.sequence ASC, leaderboard.points DESC, leaderboard.score_best ASC, leaderboard.rank ASC
+	''', (scope, value or ''))
+	scores = cursor.fetchall()
+	cursor.close()
+	db.close()
+	return scores
+
+def get_scoreboard_version():
+	"""Get (version, updated_at) of the scoreboard data, the version changes whenever a scoreboard would change."""
+	(db, cursor) = connect()
+	cursor.execute('SELECT version, updated_at FROM scoreboard_version WHERE id = 1')
+	version = cursor.fetchone()
+	cursor.close()
+	db.close()
+	return version
+
 def get_last_user_submission(taskid, userid):
 	"""Get a user's submission for a task."""
 	(db, cursor) = connect()
@@ -406,6 +561,22 @@ def ban_user(userid):
 	db.close()
 	return True
 
+def set_scoreboard_hidden(userid, hidden):
+	"""Exclude a user from (or include them in) the scoreboards."""
+	(db, cursor) = connect()
+	cursor.execute('UPDATE users SET scoreboard_hidden = %s WHERE id = %s AND scoreboard_hidden <> %s', (hidden, userid, hidden))
+	db.commit()
+	cursor.close()
+	db.close()
+
+def sync_scoreboard_hidden(usernames):
+	"""Hide exactly the users in <usernames> from the scoreboards."""
+	(db, cursor) = connect()
+	cursor.execute('UPDATE users SET scoreboard_hidden = NOT scoreboard_hidden WHERE scoreboard_hidden <> (username = ANY(%s))', (list(usernames),))
+	db.commit()
+	cursor.close()
+	db.close()
+
 def unban_user(userid):
 	"""Unban a user."""
 	#set a verified to true and token to NULL
@@ -573,7 +744,8 @@ def reevaluate_task(task_id, user_id, is_best):
 		source = cursor.fetchone()
 
 	if source:
-		cursor.execute('INSERT INTO submissions (userid, taskid, file) VALUES (%s, %s, %s)', (user_id, task_id, source))
+		# Re-evaluations go to the low priority lane, so they do not delay submissions of students
+		cursor.execute('INSERT INTO submissions (userid, taskid, file, low_priority) VALUES (%s, %s, %s, true)', (user_id, task_id, source))
 		# Also update last_source in results so the evaluator can properly update best_source via trigger
 		cursor.execute('UPDATE results SET result = -1, score_best = NULL, score_last = NULL, best_source = NULL, last_source = %s WHERE taskid = %s AND userid = %s', (source[0], task_id, user_id))
 	else:
@@ -968,6 +1140,46 @@ def set_user_setting(user_id, setting_key, setting_value):
 		db.close()
 
 
+def get_result_cache_statistics():
+	"""Get (cached evaluations, hits, saved seconds) of the evaluator result cache."""
+	(db, cursor) = connect()
+	cursor.execute('SELECT COUNT(*), COALESCE(SUM(hits), 0), COALESCE(SUM(hits * eval_seconds), 0) FROM result_cache')
+	stats = cursor.fetchone()
+	cursor.close()
+	db.close()
+	return stats
+
+def get_resource_usage_statistics():
+	"""Get the resource usage of the evaluations per task and kind of run, the most CPU consuming first.
+
+	Rows are (task id, task name, kind, submissions, runs, average wall seconds per submission,
+	total CPU seconds, average CPU seconds per submission, peak RSS in kB)."""
+	(db, cursor) = connect()
+	cursor.execute('''
+		SELECT t.id, t.name, r.kind, COUNT(*), SUM(r.runs), AVG(r.wall_seconds),
+			SUM(r.user_seconds + r.sys_seconds), AVG(r.user_seconds + r.sys_seconds), MAX(r.max_rss_kb)
+		FROM resource_usage r
+		JOIN tasks t ON t.id = r.taskid
+		GROUP BY t.id, t.name, r.kind
+		ORDER BY SUM(r.user_seconds + r.sys_seconds) DESC
+	''')
+	stats = cursor.fetchall()
+	cursor.close()
+	db.close()
+	return stats
+
+def get_queue_depth():
+	"""Get (number of submissions waiting for evaluation, age of the oldest one in seconds)."""
+	(db, cursor) = connect()
+	cursor.execute('''
+		SELECT COUNT(*), COALESCE(EXTRACT(EPOCH FROM NOW() - MIN(time))::float, 0)
+		FROM submissions WHERE evaluated = false
+	''')
+	depth = cursor.fetchone()
+	cursor.close()
+	db.close()
+	return depth
+
 def get_submission_statistics(username_filter=None, organization_filter=None, group_filter=None, task_filter=None, order_by='desc'):
 	"""Get submission statistics for all users and tasks."""
 	(db, cursor) = connect()
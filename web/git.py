@@ -4,6 +4,7 @@ import hashlib
 import toml
 import requests
 import db
+import task_registry
 from flask import Blueprint, request, jsonify, current_app
 from datetime import datetime
 import urllib.parse
@@ -151,8 +152,7 @@ def process_submission_logic(username, task_id, code):
 		if task_path_entry:
 			task_file_path = os.path.join(TASKS_DIR, os.path.basename(task_path_entry[0]))
 			if os.path.exists(task_file_path):
-				with open(task_file_path) as f:
-					task_data = toml.load(f)
+				task_data = task_registry.get_task_data(task_file_path)
 				
 				deadlines = task_data.get('task', {})
 				start_date = deadlines.get('start_date')
@@ -0,0 +1,124 @@
+"""Prometheus metrics of the web server.
+
+Every gunicorn worker measures its own requests and database calls. With METRICS_DIR set,
+the workers also dump their metrics into <METRICS_DIR>/<pid>.json (at most once per
+METRICS_FLUSH_INTERVAL seconds) and /metrics sums the files of all workers, so the answer
+does not depend on the worker that serves the scrape. The directory should be emptied when
+the server starts.
+"""
+
+import os
+import time
+import json
+import tempfile
+import threading
+
+METRICS_DIR = os.getenv('METRICS_DIR') or None
+FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL') or 5)
+
+# Upper bounds of the histogram buckets in seconds
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+	'webeval_http_request_duration_seconds': ('histogram', 'Latency of HTTP requests per blueprint.', REQUEST_BUCKETS),
+	'webeval_db_call_duration_seconds': ('histogram', 'Time from db.connect() to closing the connection per db function.', DB_BUCKETS),
+	'webeval_queue_depth': ('gauge', 'Submissions waiting for evaluation.', None),
+	'webeval_oldest_pending_seconds': ('gauge', 'Age of the oldest submission waiting for evaluation.', None),
+}
+
+_lock = threading.Lock()
+_histograms = {}			# (name, labels) -> [count per bucket..., count above the last bucket, sum]
+_last_flush = 0.0
+
+
+def observe(name, value, labels=()):
+	"""Add <value> to the histogram <name>, <labels> are (label, value) pairs."""
+	buckets = METRICS[name][2]
+	with _lock:
+		histogram = _histograms.get((name, labels))
+		if histogram is None:
+			histogram = _histograms[(name, labels)] = [0] * (len(buckets) + 1) + [0.0]
+		index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+		histogram[index] += 1
+		histogram[-1] += value
+
+
+def _snapshot():
+	with _lock:
+		return [[name, [list(label) for label in labels], list(histogram)] for (name, labels), histogram in _histograms.items()]
+
+
+def flush(force=False):
+	"""Write the metrics of this worker into METRICS_DIR, at most once per FLUSH_INTERVAL unless <force>."""
+	global _last_flush
+	now = time.monotonic()
+	if METRICS_DIR is None or (not force and now - _last_flush < FLUSH_INTERVAL):
+		return
+	_last_flush = now
+
+	try:
+		os.makedirs(METRICS_DIR, exist_ok=True)
+		fd, tmp_path = tempfile.mkstemp(dir=METRICS_DIR, suffix='.tmp')
+		with os.fdopen(fd, 'w') as f:
+			json.dump(_snapshot(), f)
+		os.replace(tmp_path, os.path.join(METRICS_DIR, f"{os.getpid()}.json"))
+	except OSError as e:
+		print(f" [METRICS] Failed to write metrics file: {e}")
+
+
+def _collect():
+	"""Sum the histograms of all workers, only this one without METRICS_DIR."""
+	if METRICS_DIR is None:
+		return {(name, tuple(tuple(label) for label in labels)): histogram for name, labels, histogram in _snapshot()}
+
+	flush(force=True)
+	merged = {}
+	for entry in os.listdir(METRICS_DIR):
+		if not entry.endswith('.json'):
+			continue
+		try:
+			with open(os.path.join(METRICS_DIR, entry)) as f:
+				rows = json.load(f)
+		except (OSError, ValueError):
+			continue
+
+		for name, labels, histogram in rows:
+			key = (name, tuple(tuple(label) for label in labels))
+			total = merged.get(key)
+			merged[key] = histogram if total is None else [a + b for a, b in zip(total, histogram)]
+	return merged
+
+
+def _format_labels(labels):
+	if not labels:
+		return ''
+	return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+def render(gauges):
+	"""Return the metrics in the Prometheus text format, <gauges> is {name: value} of the current gauges."""
+	histograms = sorted(_collect().items())
+
+	lines = []
+	for name, (kind, description, buckets) in METRICS.items():
+		lines.append(f'# HELP {name} {description}')
+		lines.append(f'# TYPE {name} {kind}')
+
+		if kind != 'histogram':
+			if name in gauges:
+				lines.append(f'{name} {gauges[name]}')
+			continue
+
+		for (metric, labels), histogram in histograms:
+			if metric != name:
+				continue
+
+			count = 0
+			for bound, bucket in zip(buckets + ('+Inf',), histogram):
+				count += bucket
+				lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {count}')
+			lines.append(f'{name}_sum{_format_labels(labels)} {histogram[-1]}')
+			lines.append(f'{name}_count{_format_labels(labels)} {count}')
+	return '\n'.join(lines) + '\n'
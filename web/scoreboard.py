@@ -1,44 +1,75 @@
-from flask import Blueprint, render_template, session
-from util import score_results, user_total_score
+from flask import Blueprint, render_template, session, request, make_response
+from werkzeug.http import is_resource_modified
+from util import user_total_score
+import scoreboard_cache
 import db
 
-get_filtered_users = None
 check_admin = None
 
-def init_scoreboard(filter_func, admin_func):
+def init_scoreboard(admin_func):
 	"""Initialize scoreboard module with configuration."""
-	global get_filtered_users, check_admin
-	get_filtered_users = filter_func
+	global check_admin
 	check_admin = admin_func
 
 scoreboard_bp = Blueprint('scoreboard', __name__)
 
-@scoreboard_bp.route('/scoreboard/')
-def scoreboard():
-	"""Display public scoreboard."""
-	active_tasks = db.get_active_tasks()
-
+def group_by_task(rows):
+	"""Group rows of db.get_scoreboard() into {task_name: [(username, score_best, userid, points), ...]}."""
 	results = {}
+	for task_name, username, score_best, userid, points, display_name in rows:
+		task_results = results.setdefault(task_name, [])
+		if username is not None:
+			task_results.append((username, score_best, userid, points))
+	return results
+
+def scoreboard_data(scope, value=None):
+	"""Get the template data of a scoreboard, cached until the scoreboard version changes."""
+	def compute():
+		rows = db.get_scoreboard(scope, value)
+		results = group_by_task(rows)
+
+		# Get user ids from results
+		user_ids = {}
+		for task in results:
+			for result in results[task]:
+				user_ids[result[0]] = result[2]
+
+		return {
+			'submissions': results,
+			'total_score': user_total_score(results),
+			'user_ids': user_ids,
+			'displaynames': {row[1]: row[5] for row in rows if row[1] is not None},
+		}
 
-	filtered_users = get_filtered_users()
-	
-	for task in active_tasks:
-		task_id, task_name = task
+	return scoreboard_cache.get(('data', scope, value), compute)
 
-		results[task_name] = db.get_best_only_scores_for_public(task_id)
-		results[task_name] = [result for result in results[task_name] if result[0] not in filtered_users]
+def conditional_response(etag, last_modified, render, private):
+	"""Answer 304 Not Modified if the browser already has the page, otherwise render it."""
+	if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+		response = make_response(render())
+	else:
+		response = make_response('', 304)
+
+	response.set_etag(etag)
+	response.last_modified = last_modified
+	response.cache_control.no_cache = True
+	if private:
+		response.cache_control.private = True
+	else:
+		response.cache_control.public = True
+	return response
 
-	results = score_results(results)
+@scoreboard_bp.route('/scoreboard/')
+def scoreboard():
+	"""Display public scoreboard."""
+	version, updated_at = scoreboard_cache.get_version()
 
-	# Get user ids from results
-	user_ids = {}
-	for task in results:
-		for result in results[task]:
-			if result[0] not in user_ids:
-				user_ids[result[0]] = 0
-			user_ids[result[0]] = result[2]
+	# Anonymous visitors all get the same page
+	if 'logged_in' not in session and 'user_id' not in session:
+		def render():
+			return scoreboard_cache.get(('html', 'public'), lambda: render_template('scoreboard.html', sessions=session, user=None, grouporg=None, **scoreboard_data('public')))
 
-	total_score = user_total_score(results)
+		return conditional_response(scoreboard_cache.make_etag(version, 'public'), updated_at, render, private=False)
 
 	user_dict = None
 	if 'user_id' in session:
@@ -55,68 +86,48 @@ def scoreboard():
 			'visibility': user[11]
 		}
 
-	displaynames = db.get_user_displaynames()
-	displaynames = {user[0]: user[1] for user in displaynames}
+	etag = scoreboard_cache.make_etag(version, 'public', session.get('user_id'), check_admin(), user_dict)
+
+	def render():
+		return render_template('scoreboard.html', sessions=session, user=user_dict, grouporg=None, **scoreboard_data('public'))
 
-	return render_template('scoreboard.html', sessions=session, submissions=results, total_score=total_score, user_ids=user_ids, user=user_dict, grouporg=None, displaynames=displaynames)
+	return conditional_response(etag, updated_at, render, private=True)
 
 
 @scoreboard_bp.route('/scoreboard/grouporg/<int:type>/<string:grouporg>/')
 def scoreboard_group(type, grouporg):
 	"""Display scoreboard filtered by group or organization."""
-	active_tasks = db.get_active_tasks()
-
 	is_admin = check_admin()
 
-	results = {}
-
 	user_id = session.get('user_id')
 
 	user = db.get_user_by_id(user_id) if user_id else None
 	user_group = user[10] if user else None
 	user_org = user[9] if user else None
 
-	results = {}
 	group_text = None
 
 	if type == 0:  # group
 		if user_group != grouporg and not is_admin:
 			return render_template('403.html'), 403
-		
+
 		group_text = "study group " + grouporg
-		filtered_users = get_filtered_users()
-		for task in active_tasks:
-			task_id, task_name = task
-			results[task_name] = db.get_best_only_scores_for_group(task_id, grouporg)
-			results[task_name] = [result for result in results[task_name] if result[0] not in filtered_users]
+		scope = 'group'
 
 	elif type == 1:  # organization
 		if user_org != grouporg and not is_admin:
 			return render_template('403.html'), 403
-		
+
 		group_text = grouporg
-		filtered_users = get_filtered_users()
-		
-		for task in active_tasks:
-			task_id, task_name = task
-			results[task_name] = db.get_best_only_scores_for_org(task_id, grouporg)
-			results[task_name] = [result for result in results[task_name] if result[0] not in filtered_users]
+		scope = 'org'
 
 	else:
 		return render_template('400.html'), 400
 
-	results = score_results(results)
-
-	user_ids = {}
-	for task in results:
-		for result in results[task]:
-			if result[0] not in user_ids:
-				user_ids[result[0]] = 0
-			user_ids[result[0]] = result[2]
-
-	total_score = user_total_score(results)
+	version, updated_at = scoreboard_cache.get_version()
+	etag = scoreboard_cache.make_etag(version, scope, grouporg, user_id, is_admin)
 
-	displaynames = db.get_user_displaynames()
-	displaynames = {user[0]: user[1] for user in displaynames}
+	def render():
+		return render_template('scoreboard.html', sessions=session, user=None, grouporg=group_text, **scoreboard_data(scope, grouporg))
 
-	return render_template('scoreboard.html', sessions=session, submissions=results, total_score=total_score, user_ids=user_ids, user=None, grouporg=group_text, displaynames=displaynames)
+	return conditional_response(etag, updated_at, render, private=True)
@@ -0,0 +1,81 @@
+"""Cache of scoreboard data and rendered pages.
+
+Entries are tagged with the scoreboard version (table scoreboard_version), which the database
+bumps whenever the leaderboard, a shown user or a task changes. A worker checks the version
+at most once per SCOREBOARD_CACHE_TTL seconds. With SCOREBOARD_CACHE_DIR set, entries are also
+stored as files there, so all workers of the web server can reuse them.
+"""
+
+import os
+import time
+import json
+import hashlib
+import tempfile
+import db
+
+CACHE_TTL = float(os.getenv('SCOREBOARD_CACHE_TTL') or 5)
+CACHE_DIR = os.getenv('SCOREBOARD_CACHE_DIR') or None
+
+_version = None				# (version, updated_at)
+_version_checked_at = 0.0
+_entries = {}				# key -> (version, value)
+
+
+def get_version():
+	"""Get (version, updated_at) of the scoreboard data."""
+	global _version, _version_checked_at
+	now = time.monotonic()
+	if _version is None or now - _version_checked_at >= CACHE_TTL:
+		_version = db.get_scoreboard_version()
+		_version_checked_at = now
+	return _version
+
+
+def make_etag(*parts):
+	"""Build an ETag from the scoreboard version and whatever else the page depends on."""
+	return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def _shared_path(key):
+	return os.path.join(CACHE_DIR, make_etag(key) + '.json')
+
+
+def _read_shared(key, version):
+	try:
+		with open(_shared_path(key)) as f:
+			entry = json.load(f)
+	except (OSError, ValueError):
+		return None
+	return entry['value'] if entry.get('version') == version else None
+
+
+def _write_shared(key, version, value):
+	try:
+		os.makedirs(CACHE_DIR, exist_ok=True)
+		fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+		with os.fdopen(fd, 'w') as f:
+			json.dump({'version': version, 'value': value}, f)
+		os.replace(tmp_path, _shared_path(key))
+	except OSError as e:
+		print(f" [SCOREBOARD] Failed to write cache file: {e}")
+
+
+def get(key, compute):
+	"""Get the cached value of <key> for the current scoreboard version, compute() it on a miss.
+
+	The value must be JSON serializable when SCOREBOARD_CACHE_DIR is used.
+	"""
+	version, _ = get_version()
+
+	entry = _entries.get(key)
+	if entry is not None and entry[0] == version:
+		return entry[1]
+
+	value = _read_shared(key, version) if CACHE_DIR else None
+	if value is None:
+		value = compute()
+		if CACHE_DIR:
+			_write_shared(key, version, value)
+
+	_entries[key] = (version, value)
+	return value
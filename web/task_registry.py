@@ -0,0 +1,84 @@
+"""Per-worker cache of parsed task files, their deadlines and template files."""
+
+import os
+import toml
+from datetime import datetime
+
+DEADLINE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+_tasks = {}		# path -> (mtime_ns, size, task_data, deadlines)
+_templates = {}	# path -> (mtime_ns, size, content)
+
+
+def _is_current(entry, stat):
+	return entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size
+
+
+def _parse_deadlines(task_data):
+	"""Parse submit_start and submit_end of a task into naive UTC datetimes."""
+	deadlines = {'submit_start': None, 'submit_end': None}
+	for key in deadlines:
+		value = task_data.get('task', {}).get(key, None)
+		if value:
+			deadlines[key] = datetime.strptime(value, DEADLINE_FORMAT)
+	return deadlines
+
+
+def _load_task(task_path):
+	"""Get the cache entry of a task file, parse it again if it changed. Returns None if the file does not exist."""
+	try:
+		stat = os.stat(task_path)
+	except OSError:
+		_tasks.pop(task_path, None)
+		return None
+
+	entry = _tasks.get(task_path)
+	if not _is_current(entry, stat):
+		with open(task_path) as f:
+			task_data = toml.load(f)
+		entry = (stat.st_mtime_ns, stat.st_size, task_data, _parse_deadlines(task_data))
+		_tasks[task_path] = entry
+
+	return entry
+
+
+def get_task_data(task_path):
+	"""Get the parsed task file, or None if it does not exist.
+
+	The returned dict is shared between requests and must not be modified.
+	"""
+	entry = _load_task(task_path)
+	return entry[2] if entry else None
+
+
+def get_deadlines(task_path):
+	"""Get {'submit_start': datetime, 'submit_end': datetime} of a task (naive UTC, None if not set)."""
+	entry = _load_task(task_path)
+	return entry[3] if entry else None
+
+
+def get_template(template_path):
+	"""Get the content of a template file, or None if it does not exist."""
+	try:
+		stat = os.stat(template_path)
+	except OSError:
+		_templates.pop(template_path, None)
+		return None
+
+	entry = _templates.get(template_path)
+	if not _is_current(entry, stat):
+		with open(template_path) as f:
+			entry = (stat.st_mtime_ns, stat.st_size, f.read())
+		_templates[template_path] = entry
+
+	return entry[2]
+
+
+def invalidate(path=None):
+	"""Drop a cached task or template file (all of them if <path> is None)."""
+	if path is None:
+		_tasks.clear()
+		_templates.clear()
+	else:
+		_tasks.pop(path, None)
+		_templates.pop(path, None)
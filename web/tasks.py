@@ -6,7 +6,7 @@ from datetime import datetime
 from auth import login_required, check_banned
 import db
 import os
-import toml
+import task_registry
 import re
 
 tasks_bp = Blueprint('tasks', __name__)
@@ -55,8 +55,7 @@ def submit(task_id):
 
 	task_data = None
 	if os.path.exists(task_path):
-		with open(task_path) as f:
-			task_data = toml.load(f)
+		task_data = task_registry.get_task_data(task_path)
 
 	if request.method == 'POST':
 		deadlines_check = check_submission_deadlines(task_data, task_name)
@@ -99,9 +98,7 @@ def submit(task_id):
 			# Support both absolute and relative paths
 			if not os.path.isabs(template_path):
 				template_path = os.path.join(TEMPLATES_DIR, os.path.basename(template_path))
-			if os.path.exists(template_path):
-				with open(template_path) as f:
-					template_code = f.read()
+			template_code = task_registry.get_template(template_path) or ""
 
 		#if user has no previous submission, use template as initial code
 		if not submission_code and template_code:
@@ -152,9 +149,8 @@ def task(task_id):
 	if not os.path.exists(task_path):
 		return render_template('404.html'), 404
 	
-	# Read toml file and get the task data
-	with open(task_path) as f:
-		task_data = toml.load(f)
+	# Get the parsed task data
+	task_data = task_registry.get_task_data(task_path)
 
 	task_name = task_data['task']['name']
 	task_description = task_data['task']['description']